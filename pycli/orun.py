@@ -6,20 +6,51 @@ Usage:
     orun "your question here"
     orun "your question" -md=model_name
     orun -m "your question" --model=model_name
+    orun --daemon              # preloaded server; later calls forward to it
+    orun --warm [model]        # preload a model before the first question
+    orun --hosts=gpu1:11434,gpu2:11434 "q"    # balance over several hosts
+    orun -o text "question" > answer.md       # plain text (piped: NDJSON)
+    orun --map-reduce --file big.log "what failed and why?"
+    orun index ~/src/app && orun --context ~/src/app "where is auth?"
+    orun --models=llama3.2,qwen2.5 "q"        # compare models side by side
+    orun autotune -md llama3.2                # save the fastest options profile
+    orun --profile long "q"                   # use a saved options profile
 
 Examples:
     orun "what time is it?"
     orun "calculate 123 * 456"
     orun "list files in current directory"
+    git diff | orun --stdin "review this change"
 """
 
 import sys
 import os
+import io
 import argparse
-import requests
 import json
+import socket
 import subprocess
 import shutil
+import signal
+import inspect
+import hashlib
+import itertools
+import mmap
+import importlib.util
+import re
+import ast
+import math
+import operator
+import stat
+import shlex
+import codecs
+import sqlite3
+import asyncio
+import threading
+import queue
+import time
+from collections import deque
+from concurrent.futures import Executor, Future, ThreadPoolExecutor
 from datetime import datetime
 
 # Fix Windows encoding issues
@@ -28,270 +59,4105 @@ if sys.platform == "win32":
     sys.stdout.reconfigure(encoding="utf-8", errors="replace")
     sys.stderr.reconfigure(encoding="utf-8", errors="replace")
 
-# Rich library for beautiful markdown output
-try:
-    from rich.console import Console
-    from rich.markdown import Markdown
-    from rich.live import Live
 
-    RICH_AVAILABLE = True
+# ============================================
+# Daemon Client
+# ============================================
+# Kept above the third-party imports: when an `orun --daemon` server is
+# listening, the call is forwarded to it before requests/rich are loaded.
+
+
+def _default_socket_path() -> str:
+    runtime_dir = os.environ.get("XDG_RUNTIME_DIR") or os.path.join(
+        os.path.expanduser("~"), ".cache", "orun"
+    )
+    return os.path.join(runtime_dir, "orun.sock")
+
+
+DAEMON_SOCKET = os.environ.get("ORUN_SOCKET") or _default_socket_path()
+DAEMON_REQUEST_TIMEOUT = 10  # seconds the daemon waits for a client's request
+
+
+def _discard_stdout() -> None:
+    """Send further output, and the flush at exit, to devnull once stdout's
+    reader is gone (`orun ... | head`)."""
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, sys.stdout.fileno())
+
+
+def daemon_client(argv: list) -> int | None:
+    """Forward argv to a running daemon and stream its output back.
+
+    Stdin is sent only when the call reads it, a frame at a time as the
+    daemon asks for more, so `while read q; do orun "$q"; done` loops and
+    large --map-reduce input work as they do locally. Returns the remote
+    exit code, or None when no daemon is listening.
+    """
+    if not hasattr(socket, "AF_UNIX") or {"--daemon", "--no-daemon"} & set(argv):
+        return None
+    if not os.path.exists(DAEMON_SOCKET):
+        return None
+
+    request = {
+        "argv": argv,
+        "cwd": os.getcwd(),
+        "env": dict(os.environ),
+        "stdin_isatty": sys.stdin is None or sys.stdin.isatty(),
+        "width": shutil.get_terminal_size().columns,
+        "isatty": sys.stdout.isatty(),
+    }
+
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(DAEMON_SOCKET)
+    except OSError:
+        sock.close()
+        return None
+    out = sys.stdout.buffer
+    try:
+        sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+        reader = sock.makefile("rb")
+        while True:
+            header = reader.read(5)
+            if len(header) < 5:
+                print("Error: orun daemon closed the connection", file=sys.stderr)
+                return 1
+            payload = reader.read(int.from_bytes(header[1:], "big"))
+            if header[:1] == b"o":
+                try:
+                    out.write(payload)
+                    out.flush()
+                except BrokenPipeError:
+                    _discard_stdout()
+                    return 1
+            elif header[:1] == b"i":
+                # The call reads stdin: send up to the requested bytes (b"" at EOF)
+                data = sys.stdin.buffer.read1(int(payload))
+                sock.sendall(b"d" + len(data).to_bytes(4, "big") + data)
+            else:
+                return int(payload)
+    except KeyboardInterrupt:
+        return 130
+    finally:
+        sock.close()
+
+
+if __name__ == "__main__":
+    _exit_code = daemon_client(sys.argv[1:])
+    if _exit_code is not None:
+        sys.exit(_exit_code)
+
+
+import requests  # noqa: E402
+
+# Rich library for beautiful markdown output. It is imported on first use,
+# so headless output (--output text/ndjson) never pays for loading it.
+RICH_AVAILABLE = importlib.util.find_spec("rich") is not None
+if not RICH_AVAILABLE:
+    print("Note: Install 'rich' for better output: pip install rich", file=sys.stderr)
+
+console = None  # see get_console()
+
+
+def get_console():
+    """The shared Rich console, created on first use."""
+    global console
+    if console is None:
+        from rich.console import Console
+
+        console = Console(force_terminal=True, legacy_windows=False)
+    return console
+
+
+# Output mode: "rich" (Markdown in the terminal), "text" (plain answer on
+# stdout, diagnostics on stderr) or "ndjson" (one JSON event per line)
+OUTPUT_MODES = ("rich", "text", "ndjson")
+_output_mode = "rich"
+
+
+def set_output_mode(mode: str) -> None:
+    global _output_mode
+    if mode not in OUTPUT_MODES:
+        raise ValueError(f"Unknown output mode: {mode}")
+    _output_mode = mode
+
+
+def use_rich() -> bool:
+    return RICH_AVAILABLE and _output_mode == "rich"
+
+
+# Optional faster JSON decoder for the stream hot loop
+try:
+    import orjson
 except ImportError:
-    RICH_AVAILABLE = False
-    print("Note: Install 'rich' for better output: pip install rich")
+    orjson = None
+
+
+def _env_list(name: str, default: str = "") -> list:
+    """Comma-separated values of environment variable `name`."""
+    return [v.strip() for v in os.environ.get(name, default).split(",") if v.strip()]
 
-if RICH_AVAILABLE:
-    console = Console(force_terminal=True, legacy_windows=False)
 
 # Configuration
-OLLAMA_URL = "http://localhost:11434/api/chat"
+OLLAMA_HOST = "http://localhost:11434"
 DEFAULT_MODEL = "mistral-large-3:675b-cloud"
 
+# Streaming render pipeline
+FRAME_RATE = 15  # max frames drawn per second while streaming
+ADAPTIVE_FRAME_RATE = True  # draw less often when the terminal is slow
+MIN_FRAME_RATE = 2
+NDJSON_FLUSH_INTERVAL = 0.05  # seconds content events may wait in the buffer
+STREAM_CHUNK_SIZE = None  # bytes per read; None hands over data as it arrives
+
+# Chat loop
+MAX_TURNS = 10  # Max turns to prevent infinite loops
+
+# Context budget: older tool output is compacted when a request gets close
+# to the context window
+NUM_CTX = 4096  # Ollama's default context window
+CONTEXT_THRESHOLD = 0.75  # compact above this fraction of num_ctx
+CONTEXT_KEEP_RECENT = 2  # newest tool results never compacted
+CONTEXT_ELIDED_CHARS = 400  # head/tail kept of a compacted tool result
+CHARS_PER_TOKEN = 4
+
+# Model warm-up (--warm / --unload)
+WARM_KEEP_ALIVE = "30m"
+WARM_TIMEOUT = 600  # seconds a large model may take to load
+PINNED_MODELS = _env_list("ORUN_PINNED_MODELS")  # requests to these send keep_alive -1
+
+# Named sessions (--session NAME)
+SESSIONS_DIR = os.path.join(
+    os.environ.get("XDG_DATA_HOME")
+    or os.path.join(os.path.expanduser("~"), ".local", "share"),
+    "orun",
+    "sessions",
+)
+SESSION_KEEP_ALIVE = "30m"  # keep the model (and its prompt cache) loaded
+
+# Batch mode
+BATCH_CONCURRENCY = 4
+
+# Performance profiles (--profile NAME): Ollama options per model, e.g.
+#   {"llama3.2": {"default": {"num_thread": 8}, "long": {"num_ctx": 16384}}}
+# Every key but keep_alive and tuned is sent as an Ollama option; a profile
+# named "default" applies when no --profile is given.
+DEFAULT_PROFILES_FILE = os.path.join(
+    os.environ.get("XDG_CONFIG_HOME")
+    or os.path.join(os.path.expanduser("~"), ".config"),
+    "orun",
+    "profiles.json",
+)
+PROFILES_FILE = os.environ.get("ORUN_PROFILES") or DEFAULT_PROFILES_FILE
+PROFILE_META_KEYS = ("keep_alive", "tuned")
+
+# orun autotune: options tried one at a time, each value against the best so far
+_CPUS = os.cpu_count() or 4
+AUTOTUNE_SWEEP = {
+    "num_thread": sorted({max(1, _CPUS // 4), max(1, _CPUS // 2), _CPUS}),
+    "num_batch": [128, 512, 1024],
+    "num_gpu": [0, 999],  # layers offloaded to the GPU (999: all of them)
+}
+AUTOTUNE_RUNS = 2  # timed runs per setting, after one untimed load
+AUTOTUNE_NUM_PREDICT = 128
+AUTOTUNE_MIN_GAIN = 0.03  # a value must be this much faster to be kept (noise)
+AUTOTUNE_PROMPT = (
+    "Explain how a hash map works, covering hashing, collisions, resizing "
+    "and the cost of each operation."
+)
+
+# Map-reduce (--map-reduce): inputs larger than the context are split into
+# chunks of this share of num_ctx, leaving room for the prompt and answer
+MAP_CHUNK_SHARE = 0.5
+CHUNK_BOUNDARIES = (b"\n\n", b"\n", b". ", b" ")  # preferred split points
+MAP_PROMPT = """This is part {index} of a larger input.
+
+Task: {prompt}
+
+Work on this part only. Keep everything the final answer will need and be concise.
+
+<input>
+{chunk}
+</input>"""
+REDUCE_PROMPT = """Below are partial answers to a task, each from a different part of one larger input.
+
+Task: {prompt}
+
+Combine them into a single answer to the task.
+
+{parts}"""
+
+# Tool execution
+TOOL_WORKERS = 4  # tool calls of one turn run concurrently on this many threads
+DEFAULT_TOOL_TIMEOUT = 60  # seconds
+TOOL_TIMEOUTS = {"get_current_date": 5, "run_command": 120}
+TOOL_GRACE_PERIOD = 2  # extra seconds a tool gets to clean up after its timeout
+TOOL_OUTPUT_LINES = 40  # live output lines shown per tool call
+
+# run_command output: the model gets the first and last bytes only
+RUN_COMMAND_HEAD_BYTES = 8 * 1024
+RUN_COMMAND_TAIL_BYTES = 8 * 1024
+RUN_COMMAND_MAX_BYTES = 64 * 1024 * 1024  # kill commands that print more
+PERSISTENT_SHELL = True  # run commands in one bash per conversation (POSIX)
+
+# In-process tools (calculate, read_file, list_dir, stat, grep)
+READ_FILE_MAX_BYTES = 64 * 1024  # per read_file call
+LIST_DIR_MAX_ENTRIES = 500
+GREP_MAX_MATCHES = 100
+GREP_MAX_FILES = 5000  # files scanned per grep call
+GREP_MAX_FILE_BYTES = 4 * 1024 * 1024  # larger files are skipped
+GREP_SKIP_DIRS = {".git", ".hg", ".svn", "node_modules", "__pycache__", ".venv"}
+CALC_MAX_BITS = 100_000  # largest integer power calculate will compute
+
+# Tool result cache (enabled with --tool-cache)
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+    "orun",
+)
+CACHE_DB = os.path.join(CACHE_DIR, "cache.sqlite3")
+TOOL_CACHE_TTL = 300  # seconds
+TOOL_CACHE_MAX_BYTES = 16 * 1024 * 1024
+TOOL_CACHE_CHECK_MTIMES = True  # also expire when a path in the arguments changes
+# In-process tools answer faster than a cache lookup
+NEVER_CACHE_TOOLS = {
+    "get_current_date",
+    "calculate",
+    "read_file",
+    "list_dir",
+    "stat",
+    "grep",
+}
+NEVER_CACHE_PATTERNS = [
+    # Commands with side effects or results that depend on time/network
+    r"\b(rm|mv|cp|mkdir|rmdir|touch|chmod|chown|ln|kill|pkill|sudo|tee|dd)\b",
+    r"\b(curl|wget|ssh|scp|rsync|ping|date|sleep|uptime|ps|top|free|df)\b",
+    r"\b(pip|npm|yarn|apt|apt-get|brew|cargo|docker|systemctl)\b",
+    r"\bgit\s+(commit|push|pull|fetch|checkout|switch|reset|merge|rebase|stash|add|rm|mv|tag|clone)\b",
+    r"(?<![0-9&])>(?!&)",  # output redirection
+    r"\$RANDOM|\brandom\b|\buuid",
+]
+
+# Response cache (enabled with --cache)
+RESPONSE_CACHE = False
+RESPONSE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+
+# Embedding index (`orun index DIR`, then `--context DIR`); needs NumPy
+INDEX_DIR = os.path.join(CACHE_DIR, "index")
+EMBED_MODEL = os.environ.get("ORUN_EMBED_MODEL", "nomic-embed-text")
+EMBED_BATCH = 32  # chunks per /api/embed request
+INDEX_CHUNK_TOKENS = 256
+INDEX_MAX_FILE_BYTES = 1024 * 1024  # larger files are not indexed
+CONTEXT_TOP_K = 5
+
+# HTTP connection pool (one session shared by every request in the process)
+HTTP_POOL_SIZE = 10
+HTTP_KEEP_ALIVE = True
+CONNECT_TIMEOUT = 5  # seconds to establish the TCP/TLS connection
+READ_TIMEOUT = 120  # seconds to wait between bytes of a streamed response
+
+# Ollama endpoints (comma-separated in ORUN_HOSTS or --hosts)
+OLLAMA_HOSTS = _env_list("ORUN_HOSTS", OLLAMA_HOST)
+POOL_STRATEGY = "least-outstanding"  # or "latency"
+HEALTH_CHECK_INTERVAL = 30  # seconds between /api/tags checks of every host
+HEALTH_CHECK_TIMEOUT = 5
+LATENCY_SMOOTHING = 0.3  # weight of the newest sample in a host's latency
+
+# Hedged requests (--hedge): if the first frame is later than this percentile
+# of recent times to first frame, the request is also sent to another host
+HEDGE_PERCENTILE = 95
+HEDGE_WINDOW = 50  # recent first-frame times kept per model
+HEDGE_MIN_SAMPLES = 5  # below this, wait HEDGE_DEFAULT_DELAY
+HEDGE_DEFAULT_DELAY = 2.0  # seconds
+HEDGE_MIN_DELAY = 0.05
+
+
+# ============================================
+# HTTP Session
+# ============================================
+
+
+class HttpClient:
+    """Pooled, keep-alive HTTP session with separate connect/read timeouts."""
+
+    def __init__(
+        self,
+        pool_size: int = HTTP_POOL_SIZE,
+        keep_alive: bool = HTTP_KEEP_ALIVE,
+        connect_timeout: float = CONNECT_TIMEOUT,
+        read_timeout: float = READ_TIMEOUT,
+    ):
+        self.options = {}
+        self.timeout = (connect_timeout, read_timeout)
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=pool_size, pool_maxsize=pool_size
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.session.headers["Connection"] = "keep-alive" if keep_alive else "close"
+
+    def post(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.post(url, **kwargs)
+
+    def get(self, url: str, **kwargs) -> requests.Response:
+        kwargs.setdefault("timeout", self.timeout)
+        return self.session.get(url, **kwargs)
+
+
+def abort_response(response: requests.Response) -> None:
+    """Close a streamed response, even while another thread is reading it.
+
+    close() alone leaves a blocked read waiting for the next byte; shutting
+    the socket down wakes the reader and tells Ollama to stop generating.
+    """
+    sock = getattr(getattr(response.raw, "connection", None), "sock", None)
+    if sock is not None:
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    response.close()
+
+
+_http_client = None
+
+
+def configure_http(**kwargs) -> HttpClient:
+    """Replace the shared HTTP client (see HttpClient for the options).
+
+    The existing client, and its warm connections, is kept when the options
+    are unchanged.
+    """
+    global _http_client
+    if _http_client is None or _http_client.options != kwargs:
+        _http_client = HttpClient(**kwargs)
+        _http_client.options = kwargs
+    return _http_client
+
+
+def get_http() -> HttpClient:
+    """Return the shared HTTP client, creating it with defaults on first use."""
+    if _http_client is None:
+        return configure_http()
+    return _http_client
+
+
+# ============================================
+# Endpoint Pool
+# ============================================
+
+
+def model_tag(name: str) -> str:
+    """Normalize a model name the way /api/tags lists it ("name:tag")."""
+    return name if ":" in name else f"{name}:latest"
+
+
+class Endpoint:
+    """One Ollama host with its load, latency and health bookkeeping."""
+
+    def __init__(self, host: str):
+        if "://" not in host:
+            host = f"http://{host}"
+        self.host = host.rstrip("/")
+        self.outstanding = 0  # requests currently streaming from this host
+        self.latency = None  # smoothed seconds to the first frame
+        self.healthy = True
+        self.models = None  # models from /api/tags; None until checked
+
+    def url(self, endpoint: str) -> str:
+        return f"{self.host}/api/{endpoint}"
+
+    def serves(self, model: str) -> bool:
+        return self.models is None or model_tag(model) in self.models
+
+
+# Errors after which a request is retried on the next endpoint
+FAILOVER_ERRORS = (
+    requests.exceptions.ConnectionError,
+    requests.exceptions.Timeout,
+    requests.exceptions.HTTPError,
+)
+
+
+class EndpointPool:
+    """Balances chat requests over Ollama hosts and fails over between them.
+
+    Hosts are ordered by health, whether they have the model, and then by
+    the strategy: "least-outstanding" picks the host with the fewest
+    streams in flight, "latency" weights that count by the host's recent
+    time to first frame. A request that fails before its first frame is
+    retried on the next host.
+
+    With `hedge` (a percentile), a request whose first frame is later than
+    that percentile of recent first-frame times is also sent to the next
+    host; the first stream to produce a frame wins and the other is
+    aborted.
+    """
+
+    def __init__(
+        self, hosts: list, strategy: str = POOL_STRATEGY, hedge: float | None = None
+    ):
+        if strategy not in ("least-outstanding", "latency"):
+            raise ValueError(f"Unknown balancing strategy: {strategy}")
+        self.hosts = list(hosts)
+        self.strategy = strategy
+        self.hedge = hedge
+        self.hedges_fired = 0
+        self.hedges_won = 0  # the hedge answered before the original request
+        self.endpoints = [Endpoint(h) for h in self.hosts]
+        self._first_frames = {}  # model -> recent seconds to first frame
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._checker = None
+
+    def _score(self, endpoint: Endpoint) -> float:
+        if self.strategy == "latency":
+            known = [e.latency for e in self.endpoints if e.latency is not None]
+            latency = endpoint.latency or (min(known) if known else 0.0)
+            return (endpoint.outstanding + 1) * latency
+        return endpoint.outstanding
+
+    def candidates(self, model: str | None = None) -> list:
+        """Endpoints to try for `model`, best first (unhealthy ones last)."""
+        with self._lock:
+            return sorted(
+                self.endpoints,
+                key=lambda e: (
+                    not e.healthy,
+                    model is not None and not e.serves(model),
+                    self._score(e),
+                    e.outstanding,
+                ),
+            )
+
+    def serving(self, model: str) -> list:
+        """Healthy endpoints that have `model` (at least the best candidate)."""
+        found = [e for e in self.endpoints if e.healthy and e.serves(model)]
+        return found or self.candidates(model)[:1]
+
+    def _begin(self, endpoint: Endpoint) -> None:
+        with self._lock:
+            endpoint.outstanding += 1
+
+    def _end(self, endpoint: Endpoint, down: bool = False) -> None:
+        with self._lock:
+            endpoint.outstanding -= 1
+            if down:
+                endpoint.healthy = False
+
+    def _record(self, endpoint: Endpoint, model: str, latency: float) -> None:
+        with self._lock:
+            endpoint.healthy = True
+            endpoint.latency = (
+                latency
+                if endpoint.latency is None
+                else LATENCY_SMOOTHING * latency
+                + (1 - LATENCY_SMOOTHING) * endpoint.latency
+            )
+            recent = self._first_frames.setdefault(model, deque(maxlen=HEDGE_WINDOW))
+            recent.append(latency)
+
+    def hedge_delay(self, model: str) -> float:
+        """Seconds to wait for a first frame before hedging a request."""
+        with self._lock:
+            recent = sorted(self._first_frames.get(model, ()))
+        if len(recent) < HEDGE_MIN_SAMPLES:
+            return HEDGE_DEFAULT_DELAY
+        index = min(len(recent) - 1, int(len(recent) * self.hedge / 100))
+        return max(HEDGE_MIN_DELAY, recent[index])
+
+    def _connect(self, endpoint: Endpoint, http: HttpClient, payload: dict, state):
+        """Open a chat stream on `endpoint` and read its first frame.
+
+        Returns (response, frames, first). The endpoint counts the request
+        as outstanding until _end(); on errors that is done here.
+        """
+        self._begin(endpoint)
+        sent = time.monotonic()
+        response = None
+        try:
+            response = http.post(endpoint.url("chat"), json=payload, stream=True)
+            state.setdefault("responses", []).append(response)
+            response.raise_for_status()
+            frames = iter_response_frames(response)
+            first = next(frames, None)
+        except BaseException as e:
+            if response is not None:
+                abort_response(response)
+            # Streams aborted on purpose say nothing about the host
+            down = (
+                isinstance(e, FAILOVER_ERRORS)
+                and not isinstance(e, requests.exceptions.HTTPError)
+                and not state.get("aborted")
+            )
+            self._end(endpoint, down=down)
+            raise
+        self._record(endpoint, payload.get("model"), time.monotonic() - sent)
+        return response, frames, first
+
+    def _open(self, candidates: list, http: HttpClient, payload: dict, state):
+        """Connect to the first candidate that answers, in order."""
+        error = None
+        for endpoint in candidates:
+            try:
+                return (endpoint, *self._connect(endpoint, http, payload, state))
+            except FAILOVER_ERRORS as e:
+                if state.get("aborted"):
+                    raise
+                error = e
+        raise error
+
+    def _open_hedged(self, candidates: list, http: HttpClient, payload: dict, state):
+        """Like _open, but start the next candidate early if the first is slow.
+
+        Each attempt runs on its own thread; the first to read a frame is
+        returned and the others are aborted (or close themselves when they
+        connect later).
+        """
+        results = queue.Queue()
+        lock = threading.Lock()
+        winner = []
+        remaining = iter(candidates)
+
+        def attempt(endpoint):
+            try:
+                opened = self._connect(endpoint, http, payload, state)
+            except Exception as e:
+                results.put((endpoint, None, e))
+                return
+            with lock:
+                if not winner:
+                    winner.append(endpoint)
+                    results.put((endpoint, opened, None))
+                    return
+            abort_response(opened[0])  # lost the race
+            self._end(endpoint)
+
+        def launch():
+            endpoint = next(remaining, None)
+            if endpoint is not None:
+                threading.Thread(target=attempt, args=(endpoint,), daemon=True).start()
+            return endpoint
+
+        delay = self.hedge_delay(payload.get("model"))
+        primary = launch()
+        running = 1
+        deadline = time.monotonic() + delay
+        hedged = False
+        error = None
+        while running:
+            timeout = None if hedged else max(0.0, deadline - time.monotonic())
+            try:
+                endpoint, opened, e = results.get(timeout=timeout)
+            except queue.Empty:
+                hedged = True
+                if launch():
+                    running += 1
+                    state["hedged"] = True
+                    with self._lock:
+                        self.hedges_fired += 1
+                continue
+            running -= 1
+            if e is not None:
+                error = e
+                if not isinstance(e, FAILOVER_ERRORS) or state.get("aborted"):
+                    break
+                if running == 0:
+                    # Plain failover: the next host gets a fresh hedge delay
+                    primary = launch()
+                    if primary is not None:
+                        running += 1
+                        deadline = time.monotonic() + delay
+                        hedged = False
+                continue
+
+            won = state.get("hedged", False) and endpoint is not primary
+            if won:
+                state["hedge_won"] = True
+                with self._lock:
+                    self.hedges_won += 1
+            state["aborted"] = True  # the losers are cancelled on purpose
+            for response in state.get("responses", []):
+                if response is not opened[0]:
+                    abort_response(response)
+            return (endpoint, *opened)
+        with lock:
+            winner.append(None)  # late connections close themselves
+        while not results.empty():
+            endpoint, opened, _ = results.get_nowait()
+            if opened is not None:
+                abort_response(opened[0])
+                self._end(endpoint)
+        raise error
+
+    def stream_chat(self, http: HttpClient, payload: dict, state: dict):
+        """Yield /api/chat frames from the first endpoint that answers.
+
+        Open responses are listed in state["responses"] (so a reader can
+        abort them to stop) and the answering host is state["endpoint"].
+        state["hedged"] and state["hedge_won"] are set when a hedge fired
+        and when it answered first.
+        """
+        candidates = self.candidates(payload.get("model"))
+        if self.hedge is not None and len(candidates) > 1:
+            opened = self._open_hedged(candidates, http, payload, state)
+        else:
+            opened = self._open(candidates, http, payload, state)
+        endpoint, response, frames, first = opened
+        state["endpoint"] = endpoint.host
+        try:
+            if first is not None:
+                yield first
+                yield from frames
+        finally:
+            response.close()
+            self._end(endpoint)
+
+    def post_json(self, http: HttpClient, api: str, payload: dict, **kwargs) -> dict:
+        """POST to /api/`api` on the best endpoint that answers; return its JSON."""
+        error = None
+        for endpoint in self.candidates(payload.get("model")):
+            self._begin(endpoint)
+            down = False
+            try:
+                response = http.post(endpoint.url(api), json=payload, **kwargs)
+                response.raise_for_status()
+                return response.json()
+            except FAILOVER_ERRORS as e:
+                error = e
+                down = not isinstance(e, requests.exceptions.HTTPError)
+            finally:
+                self._end(endpoint, down=down)
+        raise error
+
+    def check(self, endpoint: Endpoint, http: HttpClient | None = None) -> bool:
+        """Refresh an endpoint's health and model list from /api/tags."""
+        http = http or get_http()
+        try:
+            response = http.get(
+                endpoint.url("tags"), timeout=(http.timeout[0], HEALTH_CHECK_TIMEOUT)
+            )
+            response.raise_for_status()
+            models = {model_tag(m["name"]) for m in response.json().get("models", [])}
+        except (requests.exceptions.RequestException, ValueError):
+            with self._lock:
+                endpoint.healthy = False
+            return False
+        with self._lock:
+            endpoint.healthy = True
+            endpoint.models = models
+        return True
+
+    def check_all(self) -> None:
+        for endpoint in self.endpoints:
+            self.check(endpoint)
+
+    def start_health_checks(self, interval: float = HEALTH_CHECK_INTERVAL) -> None:
+        """Check every endpoint now and then every `interval` seconds."""
+        if self._checker is not None:
+            return
+
+        def loop():
+            while not self._stop.is_set():
+                self.check_all()
+                self._stop.wait(interval)
+
+        self._checker = threading.Thread(target=loop, daemon=True)
+        self._checker.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+
+_endpoint_pool = None
+
+
+def configure_pool(
+    hosts: list | None = None,
+    strategy: str = POOL_STRATEGY,
+    hedge: float | None = None,
+) -> EndpointPool:
+    """Replace the shared endpoint pool (kept when hosts and strategy match)."""
+    global _endpoint_pool
+    hosts = list(hosts or OLLAMA_HOSTS)
+    pool = _endpoint_pool
+    if pool is None or pool.hosts != hosts or pool.strategy != strategy:
+        if pool is not None:
+            pool.stop()
+        _endpoint_pool = EndpointPool(hosts, strategy)
+    _endpoint_pool.hedge = hedge
+    return _endpoint_pool
+
+
+def get_pool() -> EndpointPool:
+    """Return the shared endpoint pool, creating it from OLLAMA_HOSTS."""
+    if _endpoint_pool is None:
+        return configure_pool()
+    return _endpoint_pool
+
 
 # ============================================
 # Tool Definitions
 # ============================================
 
 
-def get_current_date() -> str:
-    """Get the current date and time."""
-    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+def get_current_date() -> str:
+    """Get the current date and time."""
+    return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+
+
+# Processes of running run_command calls, killed by cancel_tools()
+_active_processes = set()
+
+
+def _kill_process(proc: subprocess.Popen) -> None:
+    """Kill a tool process together with everything it started."""
+    if sys.platform == "win32" and proc.poll() is None:
+        # proc.kill() would end only the shell; taskkill /T also ends its
+        # children, and has to run while the shell is alive to find them
+        try:
+            subprocess.run(
+                ["taskkill", "/T", "/F", "/PID", str(proc.pid)],
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+                timeout=10,
+            )
+        except (OSError, subprocess.SubprocessError):
+            pass
+    try:
+        if sys.platform == "win32":
+            proc.kill()  # in case taskkill is unavailable
+        else:
+            os.killpg(proc.pid, signal.SIGKILL)
+    except (ProcessLookupError, PermissionError, OSError):
+        pass
+
+
+def cancel_tools() -> None:
+    """Kill every tool subprocess that is still running."""
+    for proc in list(_active_processes):
+        _kill_process(proc)
+
+
+class ToolExecutor(Executor):
+    """Runs each tool call on a daemon thread of its own.
+
+    A tool abandoned after its timeout (say, a read_file stuck on a FIFO)
+    keeps its thread, but unlike on the loop's default executor or a
+    ThreadPoolExecutor, neither asyncio.run() nor interpreter exit waits
+    for it. ChatEngine bounds how many calls run at once.
+    """
+
+    def submit(self, fn, /, *args, **kwargs) -> Future:
+        future = Future()
+
+        def run():
+            if not future.set_running_or_notify_cancel():
+                return
+            try:
+                future.set_result(fn(*args, **kwargs))
+            except BaseException as e:
+                future.set_exception(e)
+
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+
+_tool_executor = ToolExecutor()
+
+
+class BoundedOutput:
+    """Keeps the first `head` and the last `tail` bytes of a byte stream."""
+
+    def __init__(
+        self, head: int = RUN_COMMAND_HEAD_BYTES, tail: int = RUN_COMMAND_TAIL_BYTES
+    ):
+        self.head_limit = head
+        self.tail_limit = tail
+        self.head = bytearray()
+        self.tail = bytearray()
+        self.total = 0
+
+    def write(self, data: bytes) -> None:
+        self.total += len(data)
+        room = self.head_limit - len(self.head)
+        if room > 0:
+            self.head += data[:room]
+            data = data[room:]
+        if data:
+            self.tail += data
+            if len(self.tail) > 2 * self.tail_limit:
+                del self.tail[: -self.tail_limit]
+
+    def text(self) -> str:
+        tail = self.tail[-self.tail_limit :] if self.tail_limit else b""
+        omitted = self.total - len(self.head) - len(tail)
+        head_text = self.head.decode("utf-8", errors="replace")
+        tail_text = bytes(tail).decode("utf-8", errors="replace")
+        if omitted > 0:
+            return f"{head_text}\n... [{omitted} bytes truncated] ...\n{tail_text}"
+        return head_text + tail_text
+
+
+def _command_result(text: str, returncode, error: str | None = None) -> str:
+    """Format a command's output, error and exit code for the model."""
+    output_parts = []
+    text = text.strip()
+    if text:
+        output_parts.append(text)
+    if error:
+        output_parts.append(error)
+    elif returncode:
+        output_parts.append(f"Exit code: {returncode}")
+    return "\n".join(output_parts) if output_parts else "Command executed (no output)"
+
+
+def run_command(
+    command: str, timeout: float | None = None, on_output=None, shell=None
+) -> str:
+    """Run a shell command, streaming its output to `on_output` as it arrives.
+
+    Only a bounded head and tail of the output is returned. The whole
+    process group is killed after `timeout` seconds or once the output
+    exceeds RUN_COMMAND_MAX_BYTES.
+
+    With a ShellWorker `shell`, the command runs in it (keeping `cd` and
+    exported variables between calls). If the worker is busy with another
+    call, the command gets its own process, started in the worker's
+    directory.
+    """
+    if shell is not None:
+        result = shell.run(command, timeout, on_output)
+        if result is not None:
+            return result
+
+    # Determine shell
+    cmd = []
+    popen_kwargs = {}
+    if sys.platform == "win32":
+        shell_name = "pwsh"
+        if shutil.which("pwsh") is None:
+            shell_name = "powershell"
+        cmd = [shell_name, "-Command", command]
+        popen_kwargs["creationflags"] = subprocess.CREATE_NEW_PROCESS_GROUP
+    else:
+        cmd = ["bash", "-c", command]
+        popen_kwargs["start_new_session"] = True  # own process group
+
+    try:
+        # Run command
+        proc = subprocess.Popen(
+            cmd,
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            cwd=shell.cwd if shell is not None else None,
+            **popen_kwargs,
+        )
+    except Exception as e:
+        return f"Error executing command: {str(e)}"
+
+    _active_processes.add(proc)
+    output = BoundedOutput()
+    decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+    over_limit = threading.Event()
+
+    def pump():
+        while True:
+            data = proc.stdout.read1(65536)
+            if not data:
+                return
+            output.write(data)
+            if on_output:
+                on_output(decoder.decode(data))
+            if output.total > RUN_COMMAND_MAX_BYTES:
+                over_limit.set()
+                _kill_process(proc)
+                return
+
+    reader = threading.Thread(target=pump, daemon=True)
+    reader.start()
+    try:
+        reader.join(timeout)
+        timed_out = reader.is_alive()
+        if timed_out:
+            _kill_process(proc)
+            reader.join(1)
+        try:
+            returncode = proc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            returncode = None
+    finally:
+        _active_processes.discard(proc)
+
+    error = None
+    if timed_out:
+        error = f"Error: command timed out after {timeout}s (process group killed)"
+    elif over_limit.is_set():
+        error = (
+            f"Error: output exceeded {RUN_COMMAND_MAX_BYTES} bytes "
+            "(process group killed)"
+        )
+    return _command_result(output.text(), returncode, error)
+
+
+class ShellWorker:
+    """A long-lived bash that runs run_command calls one at a time.
+
+    Commands are eval'd in the same shell, so `cd` and exported variables
+    carry over between calls. Each command is followed by a sentinel line
+    with its exit status and the shell's working directory. A command that
+    times out (or floods the output) kills the shell's process group; the
+    shell is restarted, in the last known directory, on the next call.
+    """
+
+    def __init__(self, cwd: str | None = None):
+        self.cwd = cwd or os.getcwd()
+        self.proc = None
+        self._chunks = None  # output chunks read by the reader thread
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def available() -> bool:
+        return sys.platform != "win32" and shutil.which("bash") is not None
+
+    def _start(self) -> None:
+        self.proc = subprocess.Popen(
+            ["bash", "--noprofile", "--norc"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            cwd=self.cwd,
+            start_new_session=True,  # own process group, killed as a whole
+        )
+        _active_processes.add(self.proc)
+        self._chunks = queue.Queue()
+
+        def pump(stdout, chunks):
+            while True:
+                data = stdout.read1(65536)
+                chunks.put(data)
+                if not data:
+                    return
+
+        threading.Thread(
+            target=pump, args=(self.proc.stdout, self._chunks), daemon=True
+        ).start()
+
+    def close(self) -> None:
+        """Kill the shell (and anything it started)."""
+        proc, self.proc = self.proc, None
+        if proc is None:
+            return
+        _kill_process(proc)
+        _active_processes.discard(proc)
+        try:
+            proc.wait(timeout=1)
+        except subprocess.TimeoutExpired:
+            pass
+        for pipe in (proc.stdin, proc.stdout):
+            try:
+                pipe.close()
+            except OSError:
+                pass
+
+    def run(self, command: str, timeout: float | None = None, on_output=None):
+        """Run `command` in the shell; None if another call is using it."""
+        if not self._lock.acquire(blocking=False):
+            return None
+        try:
+            return self._run(command, timeout, on_output)
+        finally:
+            self._lock.release()
+
+    def _run(self, command: str, timeout: float | None, on_output) -> str:
+        sentinel = f"__orun_done_{os.urandom(8).hex()}__"
+        script = (
+            f"eval {shlex.quote(command)} < /dev/null 2>&1; "
+            f'printf \'\\n%s %d %s\\n\' {sentinel} "$?" "$PWD"\n'
+        )
+        for attempt in range(2):
+            if self.proc is None or self.proc.poll() is not None:
+                self.close()
+                self._start()
+            try:
+                self.proc.stdin.write(script.encode("utf-8"))
+                self.proc.stdin.flush()
+                break
+            except OSError:
+                self.close()  # the shell died between calls; start a new one
+        else:
+            return "Error: could not start a shell"
+
+        marker = f"\n{sentinel} ".encode("ascii")
+        output = BoundedOutput()
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        pending = bytearray()
+        deadline = None if timeout is None else time.monotonic() + timeout
+        returncode = error = None
+
+        def emit(data):
+            if data:
+                output.write(bytes(data))
+                if on_output:
+                    on_output(decoder.decode(bytes(data)))
+
+        while True:
+            wait = None if deadline is None else deadline - time.monotonic()
+            try:
+                if wait is not None and wait <= 0:
+                    raise queue.Empty
+                data = self._chunks.get(timeout=wait)
+            except queue.Empty:
+                error = f"Error: command timed out after {timeout}s (shell restarted)"
+                break
+            if not data:
+                # The command ended the shell (e.g. `exit 3`)
+                emit(pending)
+                returncode = self.proc.wait()
+                self.close()
+                break
+
+            pending += data
+            found = pending.find(marker)
+            if found >= 0:
+                end = pending.find(b"\n", found + len(marker))
+                if end < 0:
+                    continue  # rest of the sentinel line still to come
+                emit(pending[:found])
+                trailer = pending[found + len(marker) : end].decode("utf-8", "replace")
+                status, _, cwd = trailer.partition(" ")
+                returncode = int(status)
+                self.cwd = cwd or self.cwd
+                break
+
+            # Hold back only a trailing partial sentinel line
+            hold = pending.rfind(b"\n", max(0, len(pending) - len(marker) + 1))
+            if hold < 0 or not marker.startswith(pending[hold:]):
+                hold = len(pending)
+            emit(pending[:hold])
+            del pending[:hold]
+            if output.total > RUN_COMMAND_MAX_BYTES:
+                error = (
+                    f"Error: output exceeded {RUN_COMMAND_MAX_BYTES} bytes "
+                    "(shell restarted)"
+                )
+                break
+
+        if error:
+            self.close()
+        return _command_result(output.text(), returncode, error)
+
+
+# ============================================
+# Native Tools
+# ============================================
+
+_CALC_OPERATORS = {
+    ast.Add: operator.add,
+    ast.Sub: operator.sub,
+    ast.Mult: operator.mul,
+    ast.Div: operator.truediv,
+    ast.FloorDiv: operator.floordiv,
+    ast.Mod: operator.mod,
+    ast.Pow: operator.pow,
+    ast.UAdd: operator.pos,
+    ast.USub: operator.neg,
+}
+_CALC_FUNCTIONS = {
+    name: getattr(math, name)
+    for name in (
+        "sqrt exp log log10 log2 sin cos tan asin acos atan atan2 sinh cosh "
+        "tanh degrees radians floor ceil hypot gcd"
+    ).split()
+}
+_CALC_FUNCTIONS.update(abs=abs, round=round, min=min, max=max)
+_CALC_CONSTANTS = {"pi": math.pi, "e": math.e, "tau": math.tau, "inf": math.inf}
+
+
+def _calc(node):
+    if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+        return node.value
+    if isinstance(node, ast.Name) and node.id in _CALC_CONSTANTS:
+        return _CALC_CONSTANTS[node.id]
+    if isinstance(node, ast.UnaryOp) and type(node.op) in _CALC_OPERATORS:
+        return _CALC_OPERATORS[type(node.op)](_calc(node.operand))
+    if isinstance(node, ast.BinOp) and type(node.op) in _CALC_OPERATORS:
+        left, right = _calc(node.left), _calc(node.right)
+        if (
+            isinstance(node.op, ast.Pow)
+            and isinstance(left, int)
+            and isinstance(right, int)
+            and abs(left) > 1
+            and abs(left).bit_length() * right > CALC_MAX_BITS
+        ):
+            raise ValueError(f"result larger than {CALC_MAX_BITS} bits")
+        return _CALC_OPERATORS[type(node.op)](left, right)
+    if (
+        isinstance(node, ast.Call)
+        and isinstance(node.func, ast.Name)
+        and node.func.id in _CALC_FUNCTIONS
+        and not node.keywords
+    ):
+        return _CALC_FUNCTIONS[node.func.id](*(_calc(arg) for arg in node.args))
+    raise ValueError(f"unsupported expression: {ast.unparse(node)}")
+
+
+def calculate(expression: str) -> str:
+    """Evaluate an arithmetic expression without running any code.
+
+    Numbers, + - * / // % ** (or ^), parentheses, pi/e/tau and common math
+    functions (sqrt, log, sin, floor, round, min, ...) are allowed.
+    """
+    tree = ast.parse(expression.replace("^", "**").strip(), mode="eval")
+    result = _calc(tree.body)
+    if isinstance(result, float):
+        return format(result, ".15g")
+    try:
+        return str(result)
+    except ValueError:
+        # Past Python's int-to-str digit limit (4300 digits by default)
+        magnitude = math.log10(abs(result))
+        exponent = math.floor(magnitude)
+        mantissa = format(10 ** (magnitude - exponent), ".15g")
+        sign = "-" if result < 0 else ""
+        return f"{sign}{mantissa}e+{exponent} (approximately; {exponent + 1} digits)"
+
+
+def _resolve(path: str, cwd: str | None) -> str:
+    return os.path.join(cwd or os.getcwd(), os.path.expanduser(path))
+
+
+def read_file(
+    path: str, offset: int = 0, length: int = READ_FILE_MAX_BYTES, cwd=None
+) -> str:
+    """Read up to `length` bytes of a file starting at byte `offset`."""
+    length = max(0, min(int(length), READ_FILE_MAX_BYTES))
+    offset = max(0, int(offset))
+    with open(_resolve(path, cwd), "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        f.seek(offset)
+        data = f.read(length)
+    text = data.decode("utf-8", errors="replace")
+    end = offset + len(data)
+    if offset or end < size:
+        text += f"\n[bytes {offset}-{end} of {size}]"
+    return text
+
+
+def list_dir(path: str = ".", show_hidden: bool = False, cwd=None) -> str:
+    """List a directory: one entry per line, "/" after directories."""
+    lines = []
+    total = 0
+    with os.scandir(_resolve(path, cwd)) as entries:
+        for entry in sorted(entries, key=lambda e: e.name):
+            if entry.name.startswith(".") and not show_hidden:
+                continue
+            total += 1
+            if len(lines) >= LIST_DIR_MAX_ENTRIES:
+                continue
+            if entry.is_dir():
+                lines.append(f"{entry.name}/")
+            else:
+                try:
+                    size = entry.stat().st_size
+                except OSError:
+                    size = "?"
+                lines.append(f"{entry.name}  {size}")
+    if total > len(lines):
+        lines.append(f"... {total - len(lines)} more entries")
+    return "\n".join(lines) or "(empty directory)"
+
+
+def stat_path(path: str, cwd=None) -> str:
+    """Type, size, permissions and modification time of a path."""
+    full = _resolve(path, cwd)
+    st = os.lstat(full)
+    kind = (
+        "symlink"
+        if stat.S_ISLNK(st.st_mode)
+        else (
+            "directory"
+            if stat.S_ISDIR(st.st_mode)
+            else "file" if stat.S_ISREG(st.st_mode) else "other"
+        )
+    )
+    lines = [
+        f"path: {os.path.abspath(full)}",
+        f"type: {kind}",
+        f"size: {st.st_size}",
+        f"mode: {stat.filemode(st.st_mode)}",
+        f"modified: {datetime.fromtimestamp(st.st_mtime):%Y-%m-%d %H:%M:%S}",
+    ]
+    if kind == "symlink":
+        lines.append(f"target: {os.readlink(full)}")
+    return "\n".join(lines)
+
+
+def _grep_files(root: str):
+    if os.path.isfile(root):
+        yield root
+        return
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(d for d in dirnames if d not in GREP_SKIP_DIRS)
+        for name in sorted(filenames):
+            yield os.path.join(dirpath, name)
+
+
+def grep_files(
+    pattern: str,
+    path: str = ".",
+    ignore_case: bool = False,
+    max_matches: int = GREP_MAX_MATCHES,
+    cwd=None,
+) -> str:
+    """Search files under `path` for a regular expression.
+
+    Binary files, files over GREP_MAX_FILE_BYTES and VCS/dependency
+    directories are skipped; output stops after `max_matches` lines.
+    """
+    regex = re.compile(pattern, re.IGNORECASE if ignore_case else 0)
+    root = _resolve(path, cwd)
+    max_matches = max(1, min(int(max_matches), GREP_MAX_MATCHES))
+    matches = []
+    scanned = 0
+    for file_path in _grep_files(root):
+        scanned += 1
+        if scanned > GREP_MAX_FILES or len(matches) >= max_matches:
+            break
+        try:
+            if os.path.getsize(file_path) > GREP_MAX_FILE_BYTES:
+                continue
+            with open(file_path, "rb") as f:
+                data = f.read()
+        except OSError:
+            continue
+        if b"\0" in data[:8192]:
+            continue  # binary
+        shown = os.path.relpath(file_path, cwd or os.getcwd())
+        for lineno, line in enumerate(data.decode("utf-8", "replace").splitlines(), 1):
+            if regex.search(line):
+                matches.append(f"{shown}:{lineno}: {line.strip()[:200]}")
+                if len(matches) >= max_matches:
+                    break
+    if not matches:
+        return "No matches"
+    if len(matches) >= max_matches or scanned > GREP_MAX_FILES:
+        matches.append("... (output limit reached)")
+    return "\n".join(matches)
+
+
+def _tool(name: str, description: str, properties: dict, required: list) -> dict:
+    return {
+        "type": "function",
+        "function": {
+            "name": name,
+            "description": description,
+            "parameters": {
+                "type": "object",
+                "required": required,
+                "properties": properties,
+            },
+        },
+    }
+
+
+NATIVE_TOOL_DEFINITIONS = [
+    _tool(
+        "calculate",
+        "Evaluate an arithmetic expression exactly, e.g. '1245*1457' or "
+        "'sqrt(2)**10 / 3'. Supports + - * / // % **, parentheses, pi, e and "
+        "math functions (sqrt, log, sin, cos, floor, ceil, round, min, max).",
+        {"expression": {"type": "string", "description": "The expression"}},
+        ["expression"],
+    ),
+    _tool(
+        "read_file",
+        f"Read a text file, or a byte range of it (at most {READ_FILE_MAX_BYTES} "
+        "bytes per call).",
+        {
+            "path": {"type": "string", "description": "File path"},
+            "offset": {"type": "integer", "description": "First byte (default 0)"},
+            "length": {"type": "integer", "description": "Number of bytes"},
+        },
+        ["path"],
+    ),
+    _tool(
+        "list_dir",
+        "List the entries of a directory with file sizes.",
+        {
+            "path": {"type": "string", "description": "Directory (default '.')"},
+            "show_hidden": {"type": "boolean", "description": "Include dotfiles"},
+        },
+        [],
+    ),
+    _tool(
+        "stat",
+        "Get the type, size, permissions and modification time of a path.",
+        {"path": {"type": "string", "description": "File or directory path"}},
+        ["path"],
+    ),
+    _tool(
+        "grep",
+        "Search files under a path for a regular expression; returns "
+        "file:line: text matches.",
+        {
+            "pattern": {"type": "string", "description": "Regular expression"},
+            "path": {"type": "string", "description": "File or directory"},
+            "ignore_case": {"type": "boolean", "description": "Case-insensitive"},
+            "max_matches": {
+                "type": "integer",
+                "description": f"Stop after this many (max {GREP_MAX_MATCHES})",
+            },
+        },
+        ["pattern"],
+    ),
+]
+
+
+TOOL_DEFINITIONS = [
+    {
+        "type": "function",
+        "function": {
+            "name": "get_current_date",
+            "description": "Get the current date and time",
+            "parameters": {"type": "object", "properties": {}, "required": []},
+        },
+    },
+    {
+        "type": "function",
+        "function": {
+            "name": "run_command",
+            "description": "Run a shell command (pwsh on Windows, bash on Linux). Use this for programs, git and system tasks that the other tools cannot do. On Linux, cd and exported variables persist between calls.",
+            "parameters": {
+                "type": "object",
+                "required": ["command"],
+                "properties": {
+                    "command": {
+                        "type": "string",
+                        "description": "The command line to execute",
+                    }
+                },
+            },
+        },
+    },
+    *NATIVE_TOOL_DEFINITIONS,
+]
+
+AVAILABLE_FUNCTIONS = {
+    "get_current_date": get_current_date,
+    "run_command": run_command,
+    "calculate": calculate,
+    "read_file": read_file,
+    "list_dir": list_dir,
+    "stat": stat_path,
+    "grep": grep_files,
+}
+
+
+def report_error(message: str, hint: str | None = None) -> None:
+    """Print an error for the user, or an error event in ndjson output."""
+    if _output_mode == "ndjson":
+        event = {"type": "error", "message": message}
+        print(json.dumps(event, ensure_ascii=False), flush=True)
+        return
+    print(f"Error: {message}", file=sys.stderr)
+    if hint:
+        print(hint, file=sys.stderr)
+
+
+def print_dim(text: str) -> None:
+    """Print secondary diagnostics (to stderr in plain text output)."""
+    if use_rich():
+        get_console().print(text, style="dim", markup=False, highlight=False)
+    else:
+        print(text, file=sys.stderr)
+
+
+# ============================================
+# Tool Result Cache
+# ============================================
+
+
+def open_cache_db(path: str = CACHE_DB) -> sqlite3.Connection:
+    """Open the SQLite file shared by the tool and response caches."""
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return sqlite3.connect(path, check_same_thread=False, timeout=5)
+
+
+class ToolCache:
+    """SQLite-backed LRU cache of tool results.
+
+    Entries are keyed on the tool name, the normalized arguments and the
+    working directory. They expire after `ttl` seconds and, when
+    `check_mtimes` is set, as soon as the working directory or any existing
+    path named in the arguments changes mtime. The least recently used
+    entries are evicted once the stored results exceed `max_bytes`.
+    """
+
+    def __init__(
+        self,
+        path: str = CACHE_DB,
+        ttl: float = TOOL_CACHE_TTL,
+        max_bytes: int = TOOL_CACHE_MAX_BYTES,
+        check_mtimes: bool = TOOL_CACHE_CHECK_MTIMES,
+    ):
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.check_mtimes = check_mtimes
+        self.hits = 0
+        self.misses = 0
+        self._never = [re.compile(p) for p in NEVER_CACHE_PATTERNS]
+        self._lock = threading.Lock()
+        self._db = open_cache_db(path)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS tool_cache (
+                key TEXT PRIMARY KEY,
+                result TEXT NOT NULL,
+                mtimes TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL,
+                size INTEGER NOT NULL
+            )""")
+        self._db.commit()
+
+    def cacheable(self, tool_name: str, args: dict) -> bool:
+        if tool_name in NEVER_CACHE_TOOLS:
+            return False
+        text = " ".join(str(v) for v in args.values())
+        return not any(p.search(text) for p in self._never)
+
+    @staticmethod
+    def key(tool_name: str, args: dict, cwd: str) -> str:
+        normalized = {
+            k: v.strip() if isinstance(v, str) else v for k, v in args.items()
+        }
+        blob = json.dumps([tool_name, normalized, cwd], sort_keys=True)
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def _mtimes(self, args: dict, cwd: str) -> dict:
+        """mtimes of the working directory and of existing paths in the args."""
+        if not self.check_mtimes:
+            return {}
+        candidates = [cwd]
+        for value in args.values():
+            if not isinstance(value, str):
+                continue
+            try:
+                candidates.extend(shlex.split(value))
+            except ValueError:
+                candidates.extend(value.split())
+        mtimes = {}
+        for candidate in candidates[:32]:
+            path = os.path.join(cwd, os.path.expanduser(candidate))
+            try:
+                mtimes[path] = os.stat(path).st_mtime_ns
+            except (OSError, ValueError):
+                continue
+        return mtimes
+
+    def get(self, tool_name: str, args: dict, cwd: str) -> str | None:
+        key = self.key(tool_name, args, cwd)
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT result, mtimes, created FROM tool_cache WHERE key = ?", (key,)
+            ).fetchone()
+            fresh = row and now - row[2] <= self.ttl
+            if fresh and json.loads(row[1]) == self._mtimes(args, cwd):
+                self._db.execute(
+                    "UPDATE tool_cache SET accessed = ? WHERE key = ?", (now, key)
+                )
+                self._db.commit()
+                self.hits += 1
+                return row[0]
+            if row:
+                self._db.execute("DELETE FROM tool_cache WHERE key = ?", (key,))
+                self._db.commit()
+            self.misses += 1
+            return None
+
+    def put(self, tool_name: str, args: dict, cwd: str, result: str) -> None:
+        key = self.key(tool_name, args, cwd)
+        now = time.time()
+        mtimes = json.dumps(self._mtimes(args, cwd))
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO tool_cache VALUES (?, ?, ?, ?, ?, ?)",
+                (key, result, mtimes, now, now, len(result.encode("utf-8"))),
+            )
+            self._evict()
+            self._db.commit()
+
+    def _evict(self) -> None:
+        """Drop least recently used entries until under max_bytes."""
+        (total,) = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM tool_cache"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute(
+            "SELECT key, size FROM tool_cache ORDER BY accessed"
+        ).fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM tool_cache WHERE key = ?", (key,))
+            total -= size
+
+
+_tool_cache = None
+
+
+def enable_tool_cache(**kwargs) -> ToolCache:
+    """Put a ToolCache in front of AVAILABLE_FUNCTIONS."""
+    global _tool_cache
+    _tool_cache = ToolCache(**kwargs)
+    return _tool_cache
+
+
+def tool_timeout(tool_name: str) -> float:
+    return TOOL_TIMEOUTS.get(tool_name, DEFAULT_TOOL_TIMEOUT)
+
+
+def call_tool(
+    tool_name: str, args, timeout: float | None = None, on_output=None, shell=None
+) -> str:
+    """Call a tool function and return its result string.
+
+    Tools that accept them get the `timeout`, an `on_output` callback for
+    live output, the conversation's ShellWorker `shell` and the `cwd` that
+    relative paths refer to (the shell's directory).
+    """
+    func = AVAILABLE_FUNCTIONS.get(tool_name)
+    if not func:
+        return f"Error: Tool {tool_name} not found"
+
+    try:
+        # Handle argument variations (some models might send strings)
+        if isinstance(args, str):
+            try:
+                args = json.loads(args)
+            except ValueError:
+                pass  # Try passing as is if not json
+
+        if not isinstance(args, dict):
+            args = {}  # No args fallback
+
+        params = inspect.signature(func).parameters
+        cache = _tool_cache
+        if cache and not cache.cacheable(tool_name, args):
+            cache = None
+        if shell is not None and "shell" in params:
+            # The result depends on the shell's state (variables, functions,
+            # options), which is not part of the key, and a cached hit would
+            # skip the state changes the command makes
+            cache = None
+        if cache:
+            cwd = shell.cwd if shell is not None else os.getcwd()
+            cached = cache.get(tool_name, args, cwd)
+            if cached is not None:
+                return cached
+
+        call_args = dict(args)
+        if "timeout" in params:
+            call_args["timeout"] = timeout
+        if "on_output" in params:
+            call_args["on_output"] = on_output
+        if "shell" in params:
+            call_args["shell"] = shell
+        if "cwd" in params:
+            call_args["cwd"] = shell.cwd if shell is not None else None
+        result = str(func(**call_args))
+
+        if cache and "Error" not in result:
+            cache.put(tool_name, args, cwd, result)
+        return result
+    except Exception as e:
+        return f"Error: {str(e)}"
+
+
+def announce_tool(tool_name: str, args) -> None:
+    if use_rich():
+        get_console().print(f"[yellow]Running tool: {tool_name}[/yellow] args={args}")
+    else:
+        print(f"Running tool: {tool_name} args={args}", file=sys.stderr)
+
+
+# ============================================
+# Streaming Output
+# ============================================
+# The network side runs on its own thread (ChatEngine) and only decodes
+# frames; FrameRenderer draws coalesced frames at FRAME_RATE, so a slow
+# terminal never back-pressures the socket.
+
+
+def _markdown(text: str):
+    from rich.markdown import Markdown
+
+    return Markdown(text)
+
+
+class StreamingMarkdown:
+    """Markdown view of a streamed response that only re-parses the open block.
+
+    Finished blocks are printed once above the Live region by flush(); Live
+    only re-renders the trailing block that is still being written. A block
+    ends at a blank line outside a code fence, unless the next line is
+    indented or continues a list (loose lists and indented item content
+    must be parsed with their list). Once a reference-style link appears,
+    no more blocks end: its definition may come later in the response, and
+    has to be parsed together with it.
+    """
+
+    FENCES = ("```", "~~~")
+    LIST_ITEM = re.compile(r" {0,3}(?:[-*+]|\d{1,9}[.)])(?:\s|$)")
+    # Blocks Rich renders with a blank line of their own (lists, quotes, tables)
+    OPENS_BLANK = re.compile(r" {0,3}(?:(?:[-*+]|\d{1,9}[.)])(?:\s|$)|>|\|)")
+    # [text][ref], [text][] or a shortcut [ref] (not a link, image or definition)
+    REF_LINK = re.compile(r"\]\[|(?<![\w\]!])\[[^\[\]]+\](?![(\[:])")
+    CODE_SPAN = re.compile(r"`[^`]*`")
+
+    def __init__(self, console):
+        self.console = console
+        self.buffer = io.StringIO()  # full response text
+        self._lines = []  # complete lines of the open block
+        self._partial = ""  # text after the last newline
+        self._fence = None  # fence marker while inside a code block
+        self._blanks = 0  # blank lines seen after the open block
+        self._list = False  # whether the open block contains a list
+        self._hold = False  # whether a reference link keeps the block open
+        self._finished = []  # blocks waiting to be printed by flush()
+        self._gap = False  # whether a blank line is due before the next block
+        self._markdown = None
+
+    def feed(self, text: str) -> None:
+        """Append a streamed chunk of the response."""
+        self.buffer.write(text)
+        *lines, self._partial = (self._partial + text).split("\n")
+        for line in lines:
+            self._add_line(line)
+        self._markdown = None
+
+    def flush(self) -> None:
+        """Print the blocks finished since the last flush."""
+        for block in self._finished:
+            if self._gap and not self.OPENS_BLANK.match(block):
+                self.console.print()
+            markdown = _markdown(block)
+            self.console.print(markdown)
+            self._gap = not self._ends_with_rule(markdown)
+        self._finished = []
+
+    @staticmethod
+    def _ends_with_rule(markdown) -> bool:
+        """Whether the last element is a horizontal rule, which Rich draws
+        with a blank line of its own instead of one before the next element."""
+        top = [token for token in markdown.parsed if token.level == 0]
+        return bool(top) and top[-1].type == "hr"
+
+    def text(self) -> str:
+        return self.buffer.getvalue()
+
+    def _add_line(self, line: str) -> None:
+        if self._fence is None:
+            if not line.strip():
+                if self._lines:
+                    self._blanks += 1
+                return
+            item = self.LIST_ITEM.match(line) is not None
+            if self._blanks:
+                if line[0] in " \t" or (item and self._list) or self._hold:
+                    self._lines.extend([""] * self._blanks)
+                else:
+                    self._finished.append("\n".join(self._lines))
+                    self._lines = []
+                    self._list = False
+                self._blanks = 0
+            self._list = self._list or item
+            if not self._hold:
+                line_text = self.CODE_SPAN.sub("", line)
+                self._hold = self.REF_LINK.search(line_text) is not None
+        marker = line.lstrip()[:3]
+        if self._fence is None and marker in self.FENCES:
+            self._fence = marker
+        elif self._fence is not None and marker == self._fence:
+            self._fence = None
+        self._lines.append(line)
+
+    def __rich__(self):
+        if self._markdown is None:
+            lines = self._lines
+            if self._partial:
+                lines = lines + [""] * self._blanks + [self._partial]
+            text = "\n".join(lines)
+            self._markdown = _markdown(text)
+            gap = self._gap
+            if self._finished:
+                gap = not self._ends_with_rule(_markdown(self._finished[-1]))
+            if gap and text.strip() and not self.OPENS_BLANK.match(text):
+                from rich.console import Group
+
+                # The blank line flush() puts between blocks
+                self._markdown = Group("", self._markdown)
+        return self._markdown
+
+
+class RichSink:
+    """Frame sink drawing a StreamingMarkdown view through Rich Live."""
+
+    def __init__(self, console):
+        self.console = console
+        self.view = StreamingMarkdown(console)
+        from rich.live import Live
+
+        self.live = Live(self.view, console=console, auto_refresh=False)
+
+    def __enter__(self):
+        self.live.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.frame()
+        self.live.stop()
+        self.console.print()  # Newline after live
+
+    def feed(self, text: str) -> None:
+        self.view.feed(text)
+
+    def frame(self) -> None:
+        self.view.flush()
+        self.live.refresh()
+
+    def text(self) -> str:
+        return self.view.text()
+
+
+class PlainSink:
+    """Frame sink writing raw text to stdout (no Rich, or --output text)."""
+
+    def __init__(self):
+        self.buffer = io.StringIO()
+        self._pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.frame()
+        print()
+
+    def feed(self, text: str) -> None:
+        self.buffer.write(text)
+        self._pending.append(text)
+
+    def frame(self) -> None:
+        if self._pending:
+            sys.stdout.write("".join(self._pending))
+            sys.stdout.flush()
+            self._pending = []
+
+    def text(self) -> str:
+        return self.buffer.getvalue()
+
+
+class FrameStats:
+    """Counters for the render side of the streaming pipeline."""
+
+    def __init__(self):
+        self.chunks = 0  # content deltas received
+        self.frames = 0  # frames drawn
+        self.coalesced = 0  # deltas merged into an already pending frame
+        self.dropped = 0  # frame slots skipped because drawing ran late
+        self.render_time = 0.0
+
+    def as_dict(self) -> dict:
+        return dict(vars(self))
+
+    def summary(self) -> str:
+        return (
+            f"chunks={self.chunks} frames={self.frames} "
+            f"coalesced={self.coalesced} dropped={self.dropped} "
+            f"render={self.render_time * 1000:.1f}ms"
+        )
+
+
+if orjson is not None:
+    # orjson parses a memoryview of the buffer in place
+    def _load_frame(buf: bytearray, start: int, end: int):
+        return orjson.loads(memoryview(buf)[start:end])
+
+else:
+
+    def _load_frame(buf: bytearray, start: int, end: int):
+        return json.loads(buf[start:end])
+
+
+def iter_response_frames(response):
+    """Decode the NDJSON frames of a streamed /api/chat response.
+
+    Raw chunks are appended to one reusable buffer and complete lines are
+    parsed from it as bytes, without a str decode per frame (with orjson,
+    without copying the line at all). The consumed prefix is dropped once
+    per chunk rather than once per line.
+
+    The body is read to the end after the done frame: a response that is
+    left unread cannot go back to the pool for the next turn.
+    """
+    buf = bytearray()
+    chunks = response.iter_content(chunk_size=STREAM_CHUNK_SIZE)
+    for chunk in chunks:
+        buf += chunk
+        start = 0
+        while True:
+            end = buf.find(b"\n", start)
+            if end < 0:
+                break
+            if end > start:
+                try:
+                    data = _load_frame(buf, start, end)
+                except ValueError:
+                    data = None
+                if isinstance(data, dict):
+                    yield data
+                    if data.get("done", False):
+                        # Read to the end so the connection returns to the pool
+                        for _ in chunks:
+                            pass
+                        return
+            start = end + 1
+        if start:
+            del buf[:start]
+    if buf.strip():
+        try:
+            data = _load_frame(buf, 0, len(buf))
+        except ValueError:
+            return
+        if isinstance(data, dict):
+            yield data
+
+
+class FrameRenderer:
+    """Feeds streamed content to a sink and draws coalesced frames.
+
+    Content is handed to the sink as it arrives; frames are drawn at most
+    FRAME_RATE times per second (less when drawing is slow and
+    ADAPTIVE_FRAME_RATE is set). A ticker task draws whatever is still
+    pending when the stream pauses. Use inside a running event loop.
+    """
+
+    def __init__(self, sink, stats: FrameStats):
+        self.sink = sink
+        self.stats = stats
+        self.base_interval = 1.0 / FRAME_RATE
+        self.interval = self.base_interval
+        self.next_frame = time.monotonic()
+        self.pending = 0
+        self._ticker = None
+
+    def __enter__(self):
+        self.sink.__enter__()
+        self._ticker = asyncio.get_running_loop().create_task(self._tick())
+        return self
+
+    def __exit__(self, *exc):
+        self._ticker.cancel()
+        if self.pending:
+            self.stats.frames += 1
+            self.stats.coalesced += self.pending - 1
+        self.sink.__exit__(*exc)
+
+    def feed(self, text: str) -> None:
+        self.sink.feed(text)
+        self.stats.chunks += 1
+        self.pending += 1
+        if time.monotonic() >= self.next_frame:
+            self.draw()
+
+    def draw(self) -> None:
+        start = time.monotonic()
+        self.sink.frame()
+        done = time.monotonic()
+        cost = done - start
+        self.stats.frames += 1
+        self.stats.coalesced += self.pending - 1
+        self.stats.render_time += cost
+        self.pending = 0
+
+        late = done - self.next_frame
+        if late > self.interval:
+            self.stats.dropped += int(late // self.interval)
+        if ADAPTIVE_FRAME_RATE:
+            # Keep drawing under half of the frame budget
+            self.interval = min(1.0 / MIN_FRAME_RATE, max(self.base_interval, cost * 2))
+        self.next_frame = done + self.interval
+
+    async def _tick(self) -> None:
+        while True:
+            await asyncio.sleep(max(self.next_frame - time.monotonic(), 0.01))
+            if self.pending and time.monotonic() >= self.next_frame:
+                self.draw()
+
+
+# ============================================
+# Response Cache
+# ============================================
+
+
+class ResponseCache:
+    """Content-addressed cache of complete /api/chat streams.
+
+    Keyed on the hash of everything that determines a generation (model,
+    messages, tool definitions, options). The decoded frames are stored as
+    NDJSON so a hit replays through the normal renderer. Least recently used
+    streams are evicted beyond `max_bytes`; hit/miss counters persist in the
+    same database.
+    """
+
+    KEY_FIELDS = ("model", "messages", "tools", "options", "format")
+
+    def __init__(
+        self,
+        path: str = CACHE_DB,
+        max_bytes: int = RESPONSE_CACHE_MAX_BYTES,
+        refresh: bool = False,
+    ):
+        self.max_bytes = max_bytes
+        self.refresh = refresh  # regenerate and overwrite instead of reading
+        self._lock = threading.Lock()
+        self._db = open_cache_db(path)
+        self._db.execute("""CREATE TABLE IF NOT EXISTS responses (
+                key TEXT PRIMARY KEY,
+                frames TEXT NOT NULL,
+                created REAL NOT NULL,
+                accessed REAL NOT NULL,
+                size INTEGER NOT NULL
+            )""")
+        self._db.execute("""CREATE TABLE IF NOT EXISTS response_stats (
+                name TEXT PRIMARY KEY,
+                value INTEGER NOT NULL
+            )""")
+        self._db.commit()
+
+    @classmethod
+    def key(cls, payload: dict) -> str:
+        request = {field: payload.get(field) for field in cls.KEY_FIELDS}
+        blob = json.dumps(request, sort_keys=True, separators=(",", ":"))
+        return hashlib.sha256(blob.encode("utf-8")).hexdigest()
+
+    def _count(self, name: str) -> None:
+        self._db.execute(
+            """INSERT INTO response_stats VALUES (?, 1)
+            ON CONFLICT(name) DO UPDATE SET value = value + 1""",
+            (name,),
+        )
+
+    def get(self, key: str) -> list | None:
+        """Return the stored frames for a key, or None on a miss."""
+        with self._lock:
+            row = None
+            if not self.refresh:
+                row = self._db.execute(
+                    "SELECT frames FROM responses WHERE key = ?", (key,)
+                ).fetchone()
+            if row:
+                self._db.execute(
+                    "UPDATE responses SET accessed = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+            self._count("hits" if row else "misses")
+            self._db.commit()
+        if not row:
+            return None
+        return [json.loads(line) for line in row[0].splitlines()]
+
+    def put(self, key: str, frames: list) -> None:
+        blob = "\n".join(json.dumps(f, separators=(",", ":")) for f in frames)
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?)",
+                (key, blob, now, now, len(blob.encode("utf-8"))),
+            )
+            self._evict()
+            self._db.commit()
+
+    def _evict(self) -> None:
+        """Drop least recently used streams until under max_bytes."""
+        (total,) = self._db.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+        if total <= self.max_bytes:
+            return
+        rows = self._db.execute(
+            "SELECT key, size FROM responses ORDER BY accessed"
+        ).fetchall()
+        for key, size in rows:
+            if total <= self.max_bytes:
+                break
+            self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+
+    def stats(self) -> dict:
+        with self._lock:
+            counters = dict(
+                self._db.execute("SELECT name, value FROM response_stats").fetchall()
+            )
+            entries, size = self._db.execute(
+                "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+            ).fetchone()
+        hits, misses = counters.get("hits", 0), counters.get("misses", 0)
+        lookups = hits + misses
+        return {
+            "hits": hits,
+            "misses": misses,
+            "hit_rate": hits / lookups if lookups else 0.0,
+            "entries": entries,
+            "bytes": size,
+        }
+
+
+def record_frames(source, record: list):
+    """Pass frames through while keeping a copy for the response cache."""
+    for data in source:
+        record.append(data)
+        yield data
+
+
+_response_cache = None
+
+
+def enable_response_cache(**kwargs) -> ResponseCache:
+    global _response_cache
+    _response_cache = ResponseCache(**kwargs)
+    return _response_cache
+
+
+# ============================================
+# Chat Engine
+# ============================================
+
+SYSTEM_PROMPT = """
+    **You are a helpful AI assistant.**
+    - **Be concise, accurate, and practical.**
+    - **You have access to tools (calculate, read_file, list_dir, stat, grep, get_current_date, run_command).**
+    - **Use 'calculate' for math and read_file/list_dir/stat/grep to inspect files; they answer instantly.**
+    - **Use 'run_command' only for what those cannot do (running programs, git, system info).**
+    - **Answer in plain language unless the user explicitly asks for code.**
+    """
+
+
+def build_messages(prompt: str, system_prompt: str = SYSTEM_PROMPT) -> list:
+    return [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": prompt},
+    ]
+
+
+def estimate_tokens(text: str) -> int:
+    """Cheap local token estimate (no tokenizer): about CHARS_PER_TOKEN chars."""
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+class ContextBudget:
+    """Keeps each request under the model's context window.
+
+    When the estimated prompt (messages plus tool definitions) passes
+    `threshold` of `num_ctx`, older tool outputs are compacted: repeated
+    results are replaced by a back-reference, then the oldest outputs are
+    elided to a short head/tail excerpt until the request fits. The system
+    prompt, user/assistant text and the newest `keep_recent` tool results
+    are left untouched.
+    """
+
+    MESSAGE_OVERHEAD = 4  # role and template tokens per message
+
+    def __init__(
+        self,
+        num_ctx: int = NUM_CTX,
+        threshold: float = CONTEXT_THRESHOLD,
+        keep_recent: int = CONTEXT_KEEP_RECENT,
+    ):
+        self.num_ctx = num_ctx
+        self.threshold = threshold
+        self.keep_recent = keep_recent
+        self._tools_cache = (None, 0)
+
+    def message_tokens(self, msg: dict) -> int:
+        tokens = estimate_tokens(msg.get("content") or "") + self.MESSAGE_OVERHEAD
+        if msg.get("tool_calls"):
+            tokens += estimate_tokens(json.dumps(msg["tool_calls"]))
+        return tokens
+
+    def tools_tokens(self, tools: list) -> int:
+        if self._tools_cache[0] is not tools:
+            self._tools_cache = (tools, estimate_tokens(json.dumps(tools)))
+        return self._tools_cache[1]
+
+    def estimate(self, messages: list, tools: list) -> int:
+        return self.tools_tokens(tools) + sum(self.message_tokens(m) for m in messages)
+
+    def fit(self, messages: list, tools: list) -> dict:
+        """Compact `messages` in place if needed; report the tokens to send."""
+        limit = int(self.num_ctx * self.threshold)
+        before = tokens = self.estimate(messages, tools)
+        if tokens > limit:
+            tool_msgs = [m for m in messages if m.get("role") == "tool"]
+            older = tool_msgs[: max(0, len(tool_msgs) - self.keep_recent)]
+
+            # 1. Repeated results: keep the newest copy only
+            newest = {}
+            for msg in tool_msgs:
+                newest[msg["content"]] = msg
+            for msg in older:
+                if newest[msg["content"]] is not msg and len(msg["content"]) > 80:
+                    msg["content"] = "[same output as a later tool call]"
+            tokens = self.estimate(messages, tools)
+
+            # 2. Oldest first: shrink outputs to a head/tail excerpt
+            for msg in older:
+                if tokens <= limit:
+                    break
+                elided = self.elide(msg["content"])
+                if elided != msg["content"]:
+                    tokens -= self.message_tokens(msg)
+                    msg["content"] = elided
+                    tokens += self.message_tokens(msg)
+        return {"tokens": tokens, "saved": before - tokens}
+
+    @staticmethod
+    def elide(text: str, keep: int = CONTEXT_ELIDED_CHARS) -> str:
+        if len(text) <= 2 * keep + 100:
+            return text
+        lines = text.count("\n") + 1
+        return (
+            f"{text[:keep]}\n... [elided {len(text) - 2 * keep} chars of "
+            f"{lines}-line output to save context] ...\n{text[-keep:]}"
+        )
+
+
+_NS = 1e9  # Ollama reports durations in nanoseconds
+DURATION_FIELDS = (
+    "total_duration",
+    "load_duration",
+    "prompt_eval_duration",
+    "eval_duration",
+)
+
+
+def _rate(count: int, seconds: float) -> float | None:
+    return count / seconds if seconds else None
+
+
+def turn_stats(done: dict, ttft: float | None, wall: float, cached: bool) -> dict:
+    """Client and server timings of one request (durations in seconds).
+
+    `done` is Ollama's final stream frame. ttft and wall are measured by
+    the client from sending the request; network_overhead is the part of
+    wall that the server did not account for in total_duration.
+    """
+    stats = {f: done.get(f, 0) / _NS for f in DURATION_FIELDS}
+    stats["prompt_eval_count"] = done.get("prompt_eval_count", 0)
+    stats["eval_count"] = done.get("eval_count", 0)
+    stats["ttft"] = ttft
+    stats["wall"] = wall
+    stats["tool_time"] = 0.0
+    stats["cached"] = cached
+    stats["tokens_per_s"] = _rate(stats["eval_count"], stats["eval_duration"])
+    stats["prompt_eval_rate"] = _rate(
+        stats["prompt_eval_count"], stats["prompt_eval_duration"]
+    )
+    stats["network_overhead"] = (
+        None if cached or not done else max(0.0, wall - stats["total_duration"])
+    )
+    return stats
+
+
+def total_stats(turns: list, elapsed: float, tool_calls: int) -> dict:
+    """Sum per-turn stats into totals for a whole conversation."""
+    totals = {f: sum(t[f] for t in turns) for f in DURATION_FIELDS}
+    for field in ("prompt_eval_count", "eval_count", "wall", "tool_time"):
+        totals[field] = sum(t[field] for t in turns)
+    overheads = [t["network_overhead"] for t in turns]
+    totals.update(
+        turns=len(turns),
+        tool_calls=tool_calls,
+        elapsed=elapsed,
+        ttft=turns[0]["ttft"] if turns else None,
+        tokens_per_s=_rate(totals["eval_count"], totals["eval_duration"]),
+        prompt_eval_rate=_rate(
+            totals["prompt_eval_count"], totals["prompt_eval_duration"]
+        ),
+        network_overhead=(None if None in overheads else sum(overheads)),
+        hedges_fired=sum(t.get("hedged", False) for t in turns),
+        hedges_won=sum(t.get("hedge_won", False) for t in turns),
+        per_turn=turns,
+    )
+    return totals
+
+
+_STREAM_END = object()
+
+
+class ChatEngine:
+    """Asyncio chat/tool loop for Ollama.
+
+    run() is an async generator of event dicts, each with a "type":
+
+        request      {"turn", "tokens", "saved"}  estimated prompt size of a turn
+        content      {"text"}                     streamed answer delta
+        tool_call    {"index", "name", "arguments"}
+        tool_output  {"index", "name", "text"}     live output of a running tool
+        tool_result  {"index", "name", "content"}  in completion order
+        turn         {"stats"}                    timings of a finished turn
+        done         {"content", "stats"}         final answer and totals
+
+    See turn_stats() and total_stats() for the statistics.
+
+    Each run() drives one conversation, so a single engine can serve many
+    conversations concurrently. Network reads happen on a helper thread and
+    tools run in executor threads; neither blocks the event loop.
+    """
+
+    def __init__(
+        self,
+        model: str = DEFAULT_MODEL,
+        tools: list = TOOL_DEFINITIONS,
+        max_turns: int = MAX_TURNS,
+        http: HttpClient | None = None,
+        response_cache: ResponseCache | None = None,
+        options: dict | None = None,
+        budget: ContextBudget | None = None,
+        keep_alive: str | None = None,
+        pool: EndpointPool | None = None,
+    ):
+        self.model = model
+        self.tools = tools
+        self.max_turns = max_turns
+        self.http = http or get_http()
+        self.pool = pool or get_pool()
+        self.response_cache = response_cache
+        self.options = options or {}
+        # How long Ollama keeps the model loaded; pinned models stay loaded
+        if keep_alive is None and is_pinned(model):
+            keep_alive = -1
+        self.keep_alive = keep_alive
+        self.budget = budget or ContextBudget(
+            num_ctx=self.options.get("num_ctx", NUM_CTX)
+        )
+
+    async def run(self, messages: list):
+        """Run the conversation in `messages` (extended in place) to the end."""
+        # run_command state (cwd, exports) persists for this conversation only
+        shell = ShellWorker() if PERSISTENT_SHELL and ShellWorker.available() else None
+        try:
+            async for event in self._converse(messages, shell):
+                yield event
+        finally:
+            if shell is not None:
+                shell.close()
+
+    async def _converse(self, messages: list, shell: ShellWorker | None):
+        start = time.monotonic()
+        tool_count = 0
+        turns = []
+
+        for turn in range(self.max_turns):
+            report = self.budget.fit(messages, self.tools)
+            yield {"type": "request", "turn": turn + 1, **report}
+
+            payload = {
+                "model": self.model,
+                "messages": messages,
+                "stream": True,  # Process with streaming
+                "tools": self.tools,
+            }
+            if self.options:
+                payload["options"] = self.options
+            if self.keep_alive is not None:
+                payload["keep_alive"] = self.keep_alive
+
+            content = io.StringIO()
+            tool_calls = []
+            done_frame = {}
+            stream_info = {}
+            sent = time.monotonic()
+            first_token = None
+            async for data in self._stream(payload, stream_info):
+                if data.get("done"):
+                    done_frame = data
+
+                msg = data.get("message", {})
+                chunk_content = msg.get("content", "")
+                if first_token is None and (chunk_content or msg.get("tool_calls")):
+                    first_token = time.monotonic() - sent
+                if chunk_content:
+                    content.write(chunk_content)
+                    yield {"type": "content", "text": chunk_content}
+
+                # Note: Ollama might stream tool calls. We collect them.
+                if msg.get("tool_calls"):
+                    tool_calls.extend(msg["tool_calls"])
+
+            stats = turn_stats(
+                done_frame,
+                ttft=first_token,
+                wall=time.monotonic() - sent,
+                cached=stream_info.get("cached", False),
+            )
+            stats["turn"] = turn + 1
+            stats["tokens_sent"] = report["tokens"]
+            stats["endpoint"] = stream_info.get("endpoint")
+            stats["hedged"] = stream_info.get("hedged", False)
+            stats["hedge_won"] = stream_info.get("hedge_won", False)
+            turns.append(stats)
+
+            # Construct the assistant message for history
+            assistant_msg = {"role": "assistant", "content": content.getvalue()}
+            if not tool_calls:
+                # No tools used, session done
+                messages.append(assistant_msg)
+                yield {"type": "turn", "stats": stats}
+                yield {
+                    "type": "done",
+                    "content": assistant_msg["content"],
+                    "stats": total_stats(turns, time.monotonic() - start, tool_count),
+                }
+                return
+
+            assistant_msg["tool_calls"] = tool_calls
+            messages.append(assistant_msg)
+            tool_count += len(tool_calls)
+
+            calls = []
+            for index, tool_call in enumerate(tool_calls):
+                fn = tool_call["function"]
+                calls.append((fn["name"], fn["arguments"]))
+                yield {
+                    "type": "tool_call",
+                    "index": index,
+                    "name": fn["name"],
+                    "arguments": fn["arguments"],
+                }
+
+            # Execute tools concurrently, append results in call order
+            tools_start = time.monotonic()
+            results = [None] * len(calls)
+            async for event in self._run_tools(calls, shell):
+                if event["type"] == "tool_result":
+                    results[event["index"]] = event["content"]
+                yield event
+            for result_content in results:
+                messages.append({"role": "tool", "content": result_content})
+            stats["tool_time"] = time.monotonic() - tools_start
+            yield {"type": "turn", "stats": stats}
+
+        raise RuntimeError(f"No final answer after {self.max_turns} turns")
+
+    async def _stream(self, payload: dict, state: dict | None = None):
+        """Yield decoded stream frames read by a helper thread.
+
+        `state` receives "cached": True when the frames are a cache replay
+        and "endpoint": the host that answered.
+        """
+        loop = asyncio.get_running_loop()
+        frames = asyncio.Queue()
+        stop = threading.Event()
+        state = {} if state is None else state
+
+        def put(item):
+            try:
+                loop.call_soon_threadsafe(frames.put_nowait, item)
+            except RuntimeError:
+                pass  # event loop already closed
+
+        thread = threading.Thread(
+            target=self._pump, args=(payload, put, stop, state), daemon=True
+        )
+        thread.start()
+        finished = False
+        try:
+            while True:
+                item = await frames.get()
+                if item is _STREAM_END:
+                    finished = True
+                    return
+                if isinstance(item, BaseException):
+                    raise item
+                yield item
+        finally:
+            # A finished stream has already released its connection; only
+            # one stopped early (Ctrl-C, a closed consumer) is cut off
+            if not finished:
+                stop.set()
+                state["aborted"] = True
+                for response in state.get("responses", []):
+                    abort_response(response)
+
+    def _pump(self, payload: dict, put, stop: threading.Event, state: dict) -> None:
+        """Thread body: open the stream (or a cached one) and forward frames."""
+        stream = None
+        try:
+            cache = self.response_cache
+            cache_key = record = source = None
+            if cache:
+                cache_key = ResponseCache.key(payload)
+                source = cache.get(cache_key)
+                state["cached"] = source is not None
+
+            if source is None:
+                source = stream = self.pool.stream_chat(self.http, payload, state)
+                if cache_key:
+                    record = []
+                    source = record_frames(source, record)
+
+            for data in source:
+                if stop.is_set():
+                    return
+                put(data)
+
+            # Only complete streams are worth replaying
+            if record and record[-1].get("done"):
+                cache.put(cache_key, record)
+        except Exception as e:
+            if not stop.is_set():
+                put(e)
+        finally:
+            if stream is not None:
+                stream.close()  # closes the response, frees the endpoint
+            put(_STREAM_END)
+
+    async def _run_tools(self, calls: list, shell: ShellWorker | None = None):
+        """Yield tool_output and tool_result events as the tool calls run."""
+        loop = asyncio.get_running_loop()
+        slots = asyncio.Semaphore(TOOL_WORKERS)
+        events = asyncio.Queue()
+
+        def output_callback(index, name):
+            def on_output(text):
+                event = {"type": "tool_output", "index": index, "name": name}
+                event["text"] = text
+                try:
+                    loop.call_soon_threadsafe(events.put_nowait, event)
+                except RuntimeError:
+                    pass  # event loop already closed
+
+            return on_output
+
+        async def run_one(index, name, args):
+            timeout = tool_timeout(name)
+            async with slots:
+                job = loop.run_in_executor(
+                    _tool_executor,
+                    call_tool,
+                    name,
+                    args,
+                    timeout,
+                    output_callback(index, name),
+                    shell,
+                )
+                try:
+                    # The tool enforces its own timeout; this catches tools
+                    # that never return
+                    result = await asyncio.wait_for(job, timeout + TOOL_GRACE_PERIOD)
+                except asyncio.TimeoutError:
+                    result = f"Error: Tool {name} timed out after {timeout}s"
+            # Queued behind any output the tool produced before returning
+            loop.call_soon(
+                events.put_nowait,
+                {
+                    "type": "tool_result",
+                    "index": index,
+                    "name": name,
+                    "content": result,
+                },
+            )
+
+        tasks = [loop.create_task(run_one(i, *call)) for i, call in enumerate(calls)]
+        try:
+            remaining = len(tasks)
+            while remaining:
+                event = await events.get()
+                if event["type"] == "tool_result":
+                    remaining -= 1
+                yield event
+        finally:
+            for task in tasks:
+                task.cancel()
+
+
+# ============================================
+# Sessions
+# ============================================
+
+
+class ChatSession:
+    """Message history behind `orun --session NAME`.
+
+    One compact JSON message per line, holding the messages exactly as
+    they were last sent, so every follow-up request starts with the
+    messages of the previous one and Ollama can reuse its cached prompt
+    prefix instead of re-evaluating the whole conversation. New messages
+    are appended; the file is only rewritten when ContextBudget compacted
+    stored tool outputs (after which the compacted form is the prefix).
+    """
+
+    NAME_PATTERN = re.compile(r"^[A-Za-z0-9._-]+$")
+
+    def __init__(self, name: str, directory: str = SESSIONS_DIR):
+        if not self.NAME_PATTERN.match(name) or name.startswith("."):
+            raise ValueError(f"Invalid session name: {name!r}")
+        self.name = name
+        self.path = os.path.join(directory, f"{name}.jsonl")
+        self._saved = 0
+        self._contents = []  # content of each stored message
+
+    def load(self, system_prompt: str = SYSTEM_PROMPT) -> list:
+        """Return the stored messages, or a new history with the system prompt."""
+        messages = []
+        if os.path.exists(self.path):
+            with open(self.path, encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        messages.append(json.loads(line))
+                    except ValueError:
+                        continue  # torn write
+        self._saved = len(messages)
+        self._contents = [m.get("content") for m in messages]
+        if not messages:
+            messages.append({"role": "system", "content": system_prompt})
+        return messages
+
+    def save(self, messages: list) -> None:
+        """Store the messages added since load() or the last save(), and
+        stored messages that were compacted meanwhile."""
+        compacted = any(
+            m.get("content") != content for m, content in zip(messages, self._contents)
+        )
+        new = messages if compacted else messages[self._saved :]
+        if not new:
+            return
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        lines = "".join(
+            json.dumps(m, ensure_ascii=False, separators=(",", ":")) + "\n" for m in new
+        )
+        if compacted:
+            tmp = f"{self.path}.tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                f.write(lines)
+            os.replace(tmp, self.path)
+        else:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(lines)
+        self._saved = len(messages)
+        self._contents = [m.get("content") for m in messages]
+
+
+# ============================================
+# Chat Logic
+# ============================================
+
+
+class ToolOutputView:
+    """Prints live tool output line by line, up to TOOL_OUTPUT_LINES per call."""
+
+    def __init__(self):
+        self._partial = {}
+        self._shown = {}
+
+    def feed(self, event: dict) -> None:
+        index = event["index"]
+        if event["type"] == "tool_result":
+            self._print(index, self._partial.pop(index, ""))
+            return
+        *lines, self._partial[index] = (
+            self._partial.get(index, "") + event["text"]
+        ).split("\n")
+        for line in lines:
+            self._print(index, line)
+
+    def _print(self, index: int, line: str) -> None:
+        shown = self._shown.get(index, 0)
+        if not line or shown > TOOL_OUTPUT_LINES:
+            return
+        self._shown[index] = shown + 1
+        print_dim("  ..." if shown == TOOL_OUTPUT_LINES else f"  {line}")
+
+
+async def render_chat(events, verbose: bool = False) -> tuple:
+    """CLI consumer of ChatEngine events: stream Markdown, announce tools.
+
+    Returns the conversation stats of the done event and the FrameStats.
+    """
+    frame_stats = FrameStats()
+    done_stats = None
+    tool_output = ToolOutputView()
+    renderer = None
+
+    def close_renderer():
+        nonlocal renderer
+        closing, renderer = renderer, None
+        if closing is not None:
+            closing.__exit__(None, None, None)
+
+    try:
+        async for event in events:
+            kind = event["type"]
+            if kind == "content":
+                if renderer is None:
+                    sink = RichSink(get_console()) if use_rich() else PlainSink()
+                    renderer = FrameRenderer(sink, frame_stats).__enter__()
+                renderer.feed(event["text"])
+            elif kind in ("tool_call", "done"):
+                close_renderer()
+            if kind == "request" and verbose:
+                saved = f", compacted {event['saved']}" if event["saved"] else ""
+                print_dim(
+                    f"turn {event['turn']}: ~{event['tokens']} tokens sent{saved}"
+                )
+            elif kind == "tool_call":
+                announce_tool(event["name"], event["arguments"])
+            elif kind in ("tool_output", "tool_result"):
+                tool_output.feed(event)
+            elif kind == "done":
+                done_stats = event["stats"]
+    finally:
+        close_renderer()
+
+    if verbose:
+        print_dim(f"render: {frame_stats.summary()}")
+        if _response_cache:
+            stats = _response_cache.stats()
+            print_dim(f"response cache: hits={stats['hits']} misses={stats['misses']}")
+        if _tool_cache:
+            print_dim(
+                f"tool cache: hits={_tool_cache.hits} misses={_tool_cache.misses}"
+            )
+        pool = get_pool()
+        if pool.hedge is not None:
+            print_dim(f"hedges: fired={pool.hedges_fired} won={pool.hedges_won}")
+    return done_stats, frame_stats
+
+
+# Events written by --output ndjson (all of them with -v)
+NDJSON_EVENTS = {"content", "tool_call", "tool_result", "done"}
+
+
+async def write_events(events, verbose: bool = False) -> tuple:
+    """Headless consumer of ChatEngine events: one JSON object per line.
+
+    Content deltas are buffered and flushed at most every
+    NDJSON_FLUSH_INTERVAL seconds; other events are flushed right away.
+    Returns the same (done stats, FrameStats) pair as render_chat.
+    """
+    out = sys.stdout
+    done_stats = None
+    last_flush = time.monotonic()
+    async for event in events:
+        kind = event["type"]
+        if kind == "done":
+            done_stats = event["stats"]
+        if kind not in NDJSON_EVENTS and not verbose:
+            continue
+        out.write(json.dumps(event, ensure_ascii=False) + "\n")
+        now = time.monotonic()
+        if kind != "content" or now - last_flush >= NDJSON_FLUSH_INTERVAL:
+            out.flush()
+            last_flush = now
+    out.flush()
+    return done_stats, FrameStats()
+
+
+def _fmt(value, unit: str = "s", digits: int = 2) -> str:
+    return "-" if value is None else f"{value:.{digits}f}{unit}"
+
+
+STATS_COLUMNS = [
+    # (header, key, unit, digits)
+    ("TTFT", "ttft", "s", 2),
+    ("Prompt tok", "prompt_eval_count", "", 0),
+    ("Prompt tok/s", "prompt_eval_rate", "", 1),
+    ("Output tok", "eval_count", "", 0),
+    ("Tok/s", "tokens_per_s", "", 1),
+    ("Load", "load_duration", "s", 2),
+    ("Server", "total_duration", "s", 2),
+    ("Network", "network_overhead", "s", 3),
+    ("Tools", "tool_time", "s", 2),
+]
+
+
+def print_stats(stats: dict) -> None:
+    """Print per-turn and total latency/throughput statistics."""
+    rows = [
+        (
+            str(t["turn"])
+            + (" (cached)" if t["cached"] else "")
+            + (" (hedged)" if t.get("hedged") else ""),
+            t,
+        )
+        for t in stats["per_turn"]
+    ]
+    rows.append(("Total", stats))
+    if use_rich():
+        from rich.table import Table
+
+        table = Table(title=f"Stats ({stats['elapsed']:.2f}s elapsed)", box=None)
+        table.add_column("Turn", style="cyan")
+        for header, *_ in STATS_COLUMNS:
+            table.add_column(header, justify="right")
+        for label, row in rows:
+            table.add_row(
+                label, *(_fmt(row[key], unit, d) for _, key, unit, d in STATS_COLUMNS)
+            )
+        get_console().print(table)
+    else:
+        print(f"Stats ({stats['elapsed']:.2f}s elapsed)")
+        for label, row in rows:
+            cells = (f"{h}={_fmt(row[k], u, d)}" for h, k, u, d in STATS_COLUMNS)
+            print(f"  {label}: " + " ".join(cells))
+
+
+def write_stats_json(path: str, model: str, stats: dict, frame_stats) -> None:
+    totals = {k: v for k, v in stats.items() if k != "per_turn"}
+    report = {
+        "model": model,
+        "turns": stats["per_turn"],
+        "total": totals,
+        "render": frame_stats.as_dict(),
+    }
+    with open(path, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=2)
+        f.write("\n")
+
+
+def run_chat(
+    prompt: str,
+    model: str,
+    verbose: bool = False,
+    options: dict | None = None,
+    session: ChatSession | None = None,
+    keep_alive=None,
+    show_stats: bool = False,
+    stats_json: str | None = None,
+    context: str | None = None,
+) -> None:
+    """Run chat loop with tool support and streaming.
+
+    `context` (retrieved excerpts) goes in a system message before the prompt.
+    """
+    # uncomment this if you want to see the model name
+    # if RICH_AVAILABLE:
+    #     console.print(f"[dim]Using model: {model}[/dim]")
+
+    if keep_alive is None and session and not is_pinned(model):
+        keep_alive = SESSION_KEEP_ALIVE  # 0 (unload right away) is kept as given
+    engine = ChatEngine(
+        model=model,
+        response_cache=_response_cache,
+        options=options,
+        keep_alive=keep_alive,
+    )
+    if session:
+        messages = session.load()
+        messages.append({"role": "user", "content": prompt})
+    else:
+        messages = build_messages(prompt)
+    if context:
+        messages.insert(-1, {"role": "system", "content": context})
+
+    consume = write_events if _output_mode == "ndjson" else render_chat
+    try:
+        stats, frame_stats = asyncio.run(consume(engine.run(messages), verbose))
+        if session:
+            session.save(messages)
+        if stats and show_stats and _output_mode != "ndjson":
+            print_stats(stats)
+        if stats and stats_json:
+            write_stats_json(stats_json, model, stats, frame_stats)
+    except requests.exceptions.ConnectionError:
+        report_error(
+            f"Cannot connect to Ollama at {', '.join(engine.pool.hosts)}",
+            "Make sure Ollama is running: ollama serve",
+        )
+        sys.exit(1)
+    except KeyboardInterrupt:
+        cancel_tools()
+        sys.exit(130)
+    except BrokenPipeError:
+        raise  # stdout was closed: exit quietly (see __main__)
+    except Exception as e:
+        report_error(str(e))
+        sys.exit(1)
+
+
+# ============================================
+# Model Comparison
+# ============================================
+
+
+async def model_events(prompt: str, engines: dict, context: str | None = None):
+    """Ask every engine the same prompt at once; yield (model, event) pairs.
+
+    A model that fails yields an error event {"message"} instead of done,
+    without stopping the others.
+    """
+    events = asyncio.Queue()
+
+    async def converse(model, engine):
+        messages = build_messages(prompt)
+        if context:
+            messages.insert(-1, {"role": "system", "content": context})
+        try:
+            async for event in engine.run(messages):
+                await events.put((model, event))
+        except Exception as e:
+            if isinstance(e, requests.exceptions.ConnectionError):
+                e = f"Cannot connect to Ollama at {', '.join(engine.pool.hosts)}"
+            await events.put((model, {"type": "error", "message": str(e)}))
+        finally:
+            await events.put((model, None))
+
+    tasks = [
+        asyncio.create_task(converse(model, engine))
+        for model, engine in engines.items()
+    ]
+    try:
+        remaining = len(tasks)
+        while remaining:
+            model, event = await events.get()
+            if event is None:
+                remaining -= 1
+            else:
+                yield model, event
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def _tail(text: str, width: int, height: int) -> str:
+    """The end of `text` that fits `height` rows of `width` columns."""
+    lines = text.split("\n")
+    rows = 0
+    for i in range(len(lines) - 1, -1, -1):
+        rows += max(1, -(-len(lines[i]) // max(width, 1)))
+        if rows > height:
+            return "\n".join(lines[i + 1 :])
+    return text
+
+
+class ComparePanes:
+    """Side-by-side panes of concurrently streamed answers, for Rich Live.
+
+    While streaming each pane shows the tail of its answer as plain text;
+    final() renders the complete answers as Markdown.
+    """
+
+    def __init__(self, console, models: list):
+        self.console = console
+        self.models = models
+        self.text = {m: io.StringIO() for m in models}
+        self.status = {m: "waiting" for m in models}
+        self.start = time.monotonic()
+
+    def _grid(self, body):
+        from rich.panel import Panel
+        from rich.table import Table
+
+        grid = Table.grid(expand=True, padding=(0, 1))
+        for _ in self.models:
+            grid.add_column(ratio=1)
+        grid.add_row(
+            *(
+                Panel(body(m), title=m, subtitle=self.status[m], title_align="left")
+                for m in self.models
+            )
+        )
+        return grid
+
+    def __rich__(self):
+        from rich.text import Text
+
+        width = self.console.width // len(self.models) - 5
+        height = max(self.console.height - 4, 3)
+        return self._grid(lambda m: Text(_tail(self.text[m].getvalue(), width, height)))
+
+    def final(self):
+        return self._grid(lambda m: _markdown(self.text[m].getvalue()))
+
+
+COMPARE_COLUMNS = [
+    # (header, key, unit, digits)
+    ("TTFT", "ttft", "s", 2),
+    ("Tok/s", "tokens_per_s", "", 1),
+    ("Output tok", "eval_count", "", 0),
+    ("Prompt tok", "prompt_eval_count", "", 0),
+    ("Load", "load_duration", "s", 2),
+    ("Total", "elapsed", "s", 2),
+]
+
+
+def print_comparison(results: dict, elapsed: float) -> None:
+    """Print one row of stats (or the error) per model."""
+    title = f"Model comparison ({elapsed:.2f}s elapsed)"
+    if use_rich():
+        from rich.table import Table
+
+        table = Table(title=title, box=None)
+        table.add_column("Model", style="cyan")
+        for header, *_ in COMPARE_COLUMNS:
+            table.add_column(header, justify="right")
+        for model, result in results.items():
+            table.add_row(
+                model,
+                *(
+                    _fmt(result.get(key), unit, d)
+                    for _, key, unit, d in COMPARE_COLUMNS
+                ),
+            )
+        get_console().print(table)
+        for model, result in results.items():
+            if "error" in result:
+                get_console().print(
+                    f"{model}: {result['error']}",
+                    style="red",
+                    markup=False,
+                    highlight=False,
+                )
+    else:
+        print(title)
+        for model, result in results.items():
+            if "error" in result:
+                print(f"  {model}: error: {result['error']}")
+                continue
+            cells = (f"{h}={_fmt(result[k], u, d)}" for h, k, u, d in COMPARE_COLUMNS)
+            print(f"  {model}: " + " ".join(cells))
+
+
+async def compare_models(events, models: list, verbose: bool = False) -> dict:
+    """Consume model_events(): panes in Rich, answers as they finish in text,
+    model-tagged events in ndjson. Returns done stats or {"error"} per model.
+    """
+    results = {}
+    panes = live = None
+    if _output_mode == "ndjson":
+        out = sys.stdout
+    elif use_rich():
+        from rich.live import Live
+
+        panes = ComparePanes(get_console(), models)
+        live = Live(
+            panes,
+            console=get_console(),
+            refresh_per_second=FRAME_RATE,
+            transient=True,
+        )
+        live.start()
+    else:
+        answers = {m: io.StringIO() for m in models}
+
+    try:
+        async for model, event in events:
+            kind = event["type"]
+            if kind == "done":
+                results[model] = event["stats"]
+            elif kind == "error":
+                results[model] = {"error": event["message"]}
+
+            if panes is not None:
+                if kind == "content":
+                    panes.text[model].write(event["text"])
+                    panes.status[model] = (
+                        f"{time.monotonic() - panes.start:.1f}s streaming"
+                    )
+                elif kind == "tool_call":
+                    panes.status[model] = f"running {event['name']}"
+                elif kind == "done":
+                    stats = event["stats"]
+                    panes.status[model] = f"done in {stats['elapsed']:.1f}s"
+                elif kind == "error":
+                    panes.status[model] = "failed"
+            elif _output_mode == "ndjson":
+                if kind in NDJSON_EVENTS or kind == "error" or verbose:
+                    out.write(
+                        json.dumps({"model": model, **event}, ensure_ascii=False) + "\n"
+                    )
+                    if kind != "content":
+                        out.flush()
+            else:
+                if kind == "content":
+                    answers[model].write(event["text"])
+                elif kind == "tool_call" and verbose:
+                    print_dim(f"{model}: running {event['name']}")
+                elif kind == "done":
+                    print(f"== {model} ==\n{answers[model].getvalue()}\n", flush=True)
+                elif kind == "error":
+                    print(f"== {model} ==\nError: {event['message']}\n", flush=True)
+    finally:
+        if live is not None:
+            live.stop()
+            get_console().print(panes.final())
+        if _output_mode == "ndjson":
+            out.flush()
+    return {m: results[m] for m in models if m in results}
+
+
+def run_compare(
+    prompt: str,
+    settings: dict,
+    verbose: bool = False,
+    context: str | None = None,
+) -> None:
+    """Ask several models the same prompt concurrently and compare them.
+
+    `settings` maps each model to its (options, keep_alive).
+    """
+    models = list(settings)
+    engines = {
+        model: ChatEngine(
+            model=model,
+            response_cache=_response_cache,
+            options=options,
+            keep_alive=keep_alive,
+        )
+        for model, (options, keep_alive) in settings.items()
+    }
+    start = time.monotonic()
+    try:
+        results = asyncio.run(
+            compare_models(model_events(prompt, engines, context), models, verbose)
+        )
+    except KeyboardInterrupt:
+        cancel_tools()
+        sys.exit(130)
+    if _output_mode != "ndjson":
+        print_comparison(results, time.monotonic() - start)
+    if all("error" in result for result in results.values()):
+        sys.exit(1)
+
+
+# ============================================
+# Model Warm-up
+# ============================================
+
+
+def set_model_keep_alive(model: str, keep_alive, endpoint: Endpoint) -> float:
+    """Load (or, with keep_alive 0, unload) a model; returns seconds taken.
+
+    A /api/generate request without a prompt only loads the model and
+    resets how long Ollama keeps it in memory.
+    """
+    start = time.monotonic()
+    response = get_http().post(
+        endpoint.url("generate"),
+        json={"model": model, "keep_alive": keep_alive},
+        timeout=(get_http().timeout[0], WARM_TIMEOUT),
+    )
+    response.raise_for_status()
+    return time.monotonic() - start
+
+
+def is_pinned(model: str) -> bool:
+    """Whether `model` is one of PINNED_MODELS (kept loaded indefinitely)."""
+    return model_tag(model) in {model_tag(m) for m in PINNED_MODELS}
+
+
+def _model_endpoints(model: str) -> list:
+    """(endpoint, label suffix) for every pool host that has `model`."""
+    pool = get_pool()
+    if len(pool.endpoints) == 1:
+        return [(pool.endpoints[0], "")]
+    pool.check_all()
+    return [(e, f" on {e.host}") for e in pool.serving(model)]
+
+
+def warm_models(models: list, keep_alive, pinned: list = ()) -> None:
+    """Preload models so the next question does not wait for a model load.
+
+    Pinned models are loaded with keep_alive -1 (never unloaded). With
+    several hosts, a model is loaded on every host that has it.
+    """
+    jobs = [(m, keep_alive) for m in models if m not in pinned]
+    jobs += [(m, -1) for m in pinned]
+    failed = False
+    for model, model_keep_alive in jobs:
+        for endpoint, where in _model_endpoints(model):
+            try:
+                elapsed = set_model_keep_alive(model, model_keep_alive, endpoint)
+            except requests.exceptions.RequestException as e:
+                report_error(f"Could not load {model}{where}: {e}")
+                failed = True
+                continue
+            until = "pinned" if model_keep_alive == -1 else f"for {model_keep_alive}"
+            print(f"Loaded {model}{where} ({until}) in {elapsed:.1f}s")
+    if failed:
+        sys.exit(1)
+
+
+def unload_models(models: list) -> None:
+    failed = False
+    for model in models:
+        for endpoint, where in _model_endpoints(model):
+            try:
+                set_model_keep_alive(model, 0, endpoint)
+            except requests.exceptions.RequestException as e:
+                report_error(f"Could not unload {model}{where}: {e}")
+                failed = True
+                continue
+            print(f"Unloaded {model}{where}")
+    if failed:
+        sys.exit(1)
+
+
+# ============================================
+# Batch Mode
+# ============================================
+
+
+def read_batch(path: str):
+    """Yield (id, item) for every prompt in a JSONL batch file.
+
+    Each line is either a JSON object with a "prompt" (plus optional "id",
+    "model" and "system") or a bare prompt string. Lines without an id are
+    identified as "line:N" (N is the line number), which does not clash with
+    numeric ids. Other lines are yielded as an item with only an "error",
+    to be recorded without stopping the batch.
+    """
+    with open(path, encoding="utf-8") as f:
+        for lineno, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                item = json.loads(line)
+            except ValueError:
+                item = line
+            if isinstance(item, str):
+                item = {"prompt": item}
+            if not isinstance(item, dict):
+                yield f"line:{lineno}", {"error": f"line {lineno}: not a prompt"}
+                continue
+            item_id = str(item.get("id", f"line:{lineno}"))
+            fields = ("prompt", "model", "system")
+            if not isinstance(item.get("prompt"), str):
+                item = {"error": f'line {lineno}: no "prompt" string'}
+            elif any(not isinstance(item.get(k, ""), str) for k in fields):
+                item = {"error": f'line {lineno}: "model" and "system" must be strings'}
+            yield item_id, item
+
+
+def completed_batch_ids(out_path: str) -> tuple:
+    """Ids from a previous run of the same batch: (answered without error,
+    with any record).
+
+    A torn last line (from a crash mid-write) is cut off so new results are
+    appended on a clean line.
+    """
+    if not os.path.exists(out_path):
+        return set(), set()
+    done = set()
+    recorded = set()
+    good_size = 0
+    with open(out_path, "rb") as f:
+        for line in f:
+            if not line.endswith(b"\n"):
+                break
+            good_size += len(line)
+            try:
+                result = json.loads(line)
+            except ValueError:
+                continue
+            recorded.add(str(result.get("id")))
+            if "error" not in result:
+                done.add(str(result.get("id")))
+    if good_size != os.path.getsize(out_path):
+        with open(out_path, "r+b") as f:
+            f.truncate(good_size)
+    return done, recorded
+
+
+async def answer_batch_item(
+    item_id: str, item: dict, model: str, options: dict | None = None
+) -> dict:
+    """Run one batch prompt to completion and return its result record."""
+    if "error" in item:
+        return {"id": item_id, "error": item["error"]}
+    engine = ChatEngine(
+        model=item.get("model", model),
+        response_cache=_response_cache,
+        options=options,
+    )
+    messages = build_messages(item["prompt"], item.get("system", SYSTEM_PROMPT))
+    result = {"id": item_id, "model": engine.model}
+    try:
+        async for event in engine.run(messages):
+            if event["type"] == "done":
+                result["response"] = event["content"]
+                result.update(event["stats"])
+    except Exception as e:
+        result["error"] = str(e) or type(e).__name__
+    return result
+
+
+async def run_batch(
+    path: str,
+    out_path: str | None,
+    model: str,
+    concurrency: int,
+    options: dict | None = None,
+) -> None:
+    """Answer a JSONL file of prompts with at most `concurrency` in flight.
+
+    Results are written one JSON object per line as each prompt finishes.
+    With an output file, prompts already answered there are skipped, so an
+    interrupted batch resumes where it stopped. Failed prompts are retried,
+    but an error is only written for an id that has no record yet, and
+    invalid lines already recorded are skipped.
+    """
+    done_ids, recorded = completed_batch_ids(out_path) if out_path else (set(), set())
+    out = open(out_path, "a", encoding="utf-8") if out_path else sys.stdout
+    pending = set()
+    counts = {"ok": 0, "failed": 0, "skipped": 0}
+
+    def write(tasks):
+        for task in tasks:
+            result = task.result()
+            status = "failed" if "error" in result else "ok"
+            if status == "ok" or result["id"] not in recorded:
+                out.write(json.dumps(result, ensure_ascii=False) + "\n")
+                out.flush()
+                recorded.add(result["id"])
+            counts[status] += 1
+            if out_path:
+                elapsed = result.get("elapsed")
+                timing = f" {elapsed:.1f}s" if elapsed is not None else ""
+                print(
+                    f"[{counts['ok'] + counts['failed']}] {result['id']} {status}{timing}"
+                )
+
+    try:
+        for item_id, item in read_batch(path):
+            if item_id in done_ids or ("error" in item and item_id in recorded):
+                counts["skipped"] += 1
+                continue
+            if len(pending) >= concurrency:
+                finished, pending = await asyncio.wait(
+                    pending, return_when=asyncio.FIRST_COMPLETED
+                )
+                write(finished)
+            pending.add(
+                asyncio.create_task(answer_batch_item(item_id, item, model, options))
+            )
+        while pending:
+            finished, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+            write(finished)
+    finally:
+        for task in pending:
+            task.cancel()
+        if out_path:
+            out.close()
+            print(
+                f"Batch done: {counts['ok']} ok, {counts['failed']} failed, "
+                f"{counts['skipped']} already done"
+            )
+            pool = get_pool()
+            if pool.hedge is not None:
+                print(f"Hedges: {pool.hedges_fired} fired, {pool.hedges_won} won")
+
+
+# ============================================
+# Map-Reduce
+# ============================================
+
+
+def _cut(buf, start: int, limit: int, final: bool) -> int:
+    """End offset of the chunk starting at `start`: the last natural
+    boundary before `limit` (searched in the second half of the chunk)."""
+    if limit >= len(buf) and final:
+        return len(buf)
+    floor = start + (limit - start) // 2
+    for sep in CHUNK_BOUNDARIES:
+        pos = buf.rfind(sep, floor, limit)
+        if pos >= 0:
+            return pos + len(sep)
+    return limit
+
+
+def split_file(path: str, max_bytes: int):
+    """Yield chunks of a file of at most `max_bytes`, read through mmap."""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            start = 0
+            while start < len(mm):
+                end = _cut(mm, start, start + max_bytes, final=True)
+                yield mm[start:end].decode("utf-8", errors="replace")
+                start = end
+
+
+def split_stream(stream, max_bytes: int):
+    """Yield chunks of a binary stream as it is read, like split_file."""
+    buf = bytearray()
+    eof = False
+    while buf or not eof:
+        while not eof and len(buf) < max_bytes:
+            data = stream.read(max_bytes)
+            eof = not data
+            buf += data
+        if not buf:
+            return
+        end = _cut(buf, 0, min(max_bytes, len(buf)), final=eof)
+        yield buf[:end].decode("utf-8", errors="replace")
+        del buf[:end]
+
+
+def input_chunks(paths: list, stdin, max_bytes: int):
+    """Yield chunks of the --file paths (labelled by file), then of stdin."""
+    for path in paths:
+        for text in split_file(path, max_bytes):
+            yield f"[{path}]\n{text}"
+    if stdin is not None:
+        for text in split_stream(stdin, max_bytes):
+            if text.strip():
+                yield text
+
+
+async def complete(prompt: str, model: str, options: dict | None = None) -> str:
+    """One tool-less chat request, returning the answer text."""
+    engine = ChatEngine(
+        model=model, tools=[], response_cache=_response_cache, options=options
+    )
+    async for event in engine.run(build_messages(prompt)):
+        if event["type"] == "done":
+            return event["content"]
+    return ""
+
+
+def reduce_groups(parts: list, max_bytes: int) -> list:
+    """Group partial answers so each group fits one request (two at least)."""
+    groups = [[]]
+    size = 0
+    for part in parts:
+        if len(groups[-1]) >= 2 and size + len(part) > max_bytes:
+            groups.append([])
+            size = 0
+        groups[-1].append(part)
+        size += len(part)
+    return groups
+
+
+def reduce_prompt(prompt: str, parts: list) -> str:
+    blocks = "\n\n".join(
+        f"<part {i}>\n{part}\n</part {i}>" for i, part in enumerate(parts, 1)
+    )
+    return REDUCE_PROMPT.format(prompt=prompt, parts=blocks)
+
+
+async def map_reduce(
+    prompt: str,
+    chunks,
+    model: str,
+    concurrency: int,
+    max_bytes: int,
+    options: dict | None = None,
+) -> str:
+    """Map `prompt` over the chunks and reduce the answers hierarchically.
+
+    Chunks are consumed as they are produced, with at most `concurrency`
+    requests in flight. Returns the prompt of the last step (a reduce over
+    answers that fit one request, or the only map prompt), left for the
+    caller to stream.
+    """
+    chunks = iter(chunks)
+    head = [c for c in (next(chunks, None), next(chunks, None)) if c is not None]
+    if not head:
+        raise ValueError("No input to map over")
+    if len(head) == 1:
+        return MAP_PROMPT.format(index=1, prompt=prompt, chunk=head[0])
+
+    slots = asyncio.Semaphore(concurrency)
+    parts = {}
+
+    async def ask(name, index, text, total=None):
+        async with slots:
+            parts[index] = await complete(text, model, options)
+        progress = f"{len(parts)}/{total}" if total else f"{len(parts)} done"
+        print_dim(f"{name}: {progress}")
+
+    tasks = []
+    pending = set()
+    for index, chunk in enumerate(itertools.chain(head, chunks)):
+        text = MAP_PROMPT.format(index=index + 1, prompt=prompt, chunk=chunk)
+        task = asyncio.create_task(ask("map", index, text))
+        tasks.append(task)
+        pending.add(task)
+        # Do not read further ahead than the requests in flight
+        if len(pending) >= concurrency:
+            _, pending = await asyncio.wait(
+                pending, return_when=asyncio.FIRST_COMPLETED
+            )
+    await asyncio.gather(*tasks)
+
+    groups = reduce_groups([parts[i] for i in range(len(parts))], max_bytes)
+    level = 1
+    while len(groups) > 1:
+        parts = {}
+        await asyncio.gather(
+            *(
+                ask(f"reduce {level}", i, reduce_prompt(prompt, group), len(groups))
+                for i, group in enumerate(groups)
+            )
+        )
+        groups = reduce_groups([parts[i] for i in range(len(parts))], max_bytes)
+        level += 1
+    return reduce_prompt(prompt, groups[0])
+
+
+# ============================================
+# Embedding Index
+# ============================================
+
+
+def _numpy():
+    """Import NumPy, which only the embedding index needs."""
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError("the embedding index needs NumPy: pip install numpy")
+    return numpy
+
+
+def index_path(root: str) -> str:
+    """Directory holding the index of the tree at `root`."""
+    digest = hashlib.sha256(os.path.realpath(root).encode("utf-8")).hexdigest()
+    return os.path.join(INDEX_DIR, digest[:16])
+
+
+def indexable_files(root: str):
+    """Yield (relative path, full path) of the text files under `root`."""
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = sorted(
+            d for d in dirnames if d not in GREP_SKIP_DIRS and not d.startswith(".")
+        )
+        for name in sorted(filenames):
+            full = os.path.join(dirpath, name)
+            try:
+                if os.path.getsize(full) > INDEX_MAX_FILE_BYTES:
+                    continue
+            except OSError:
+                continue
+            yield os.path.relpath(full, root), full
+
+
+def chunk_lines(text: str, max_chars: int) -> list:
+    """Split text into [first line, last line, text] chunks of whole lines,
+    ending early at a blank line once a chunk is half full."""
+    chunks = []
+    lines = []
+    size = 0
+    start = 1
+    for lineno, line in enumerate(text.splitlines(), 1):
+        lines.append(line)
+        size += len(line) + 1
+        if size >= max_chars or (not line.strip() and size >= max_chars // 2):
+            chunks.append([start, lineno, "\n".join(lines)])
+            lines, size, start = [], 0, lineno + 1
+    if any(line.strip() for line in lines):
+        chunks.append([start, start + len(lines) - 1, "\n".join(lines)])
+    return [c for c in chunks if c[2].strip()]
+
+
+def embed(texts: list, model: str | None = None):
+    """Unit-length float32 embeddings of `texts`, one row per text."""
+    np = _numpy()
+    payload = {"model": model or EMBED_MODEL, "input": texts}
+    data = get_pool().post_json(get_http(), "embed", payload)
+    vectors = np.asarray(data["embeddings"], dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+class EmbeddingIndex:
+    """Chunk embeddings of one directory tree.
+
+    vectors.npy holds unit-length float32 rows (loaded memory-mapped);
+    meta.json maps every file to its mtime, size, hash and chunks, in row
+    order. Rebuilding re-embeds only files whose contents changed, or all of
+    them when `model` differs from the one the index was built with. The
+    model defaults to the index's own (EMBED_MODEL for a new index).
+    """
+
+    def __init__(self, root: str, model: str | None = None):
+        self.root = os.path.realpath(root)
+        self.model = model
+        self.path = index_path(root)
+        self.meta = {"root": self.root, "model": model, "files": {}}
+        self.vectors = None
+        self.rows = []  # (relative path, first line, last line, text) per row
+        self._load()
+        self.model = self.model or EMBED_MODEL
+
+    def _load(self) -> None:
+        meta_path = os.path.join(self.path, "meta.json")
+        vectors_path = os.path.join(self.path, "vectors.npy")
+        if not (os.path.exists(meta_path) and os.path.exists(vectors_path)):
+            return
+        with open(meta_path, encoding="utf-8") as f:
+            meta = json.load(f)
+        if self.model is None:
+            self.model = meta.get("model")
+        if meta.get("model") != self.model:
+            return  # vectors of another model are not comparable
+        vectors = _numpy().load(vectors_path, mmap_mode="r")
+        rows = [
+            (rel, *chunk)
+            for rel, entry in meta["files"].items()
+            for chunk in entry["chunks"]
+        ]
+        if len(rows) != len(vectors):
+            return  # torn write: rebuild from scratch
+        self.meta, self.vectors, self.rows = meta, vectors, rows
+
+    def update(self, progress=None) -> dict:
+        """Re-index the tree; returns counts of files and chunks handled."""
+        np = _numpy()
+        old_files = self.meta["files"]
+        old_offsets = {}
+        offset = 0
+        for rel, entry in old_files.items():
+            old_offsets[rel] = offset
+            offset += len(entry["chunks"])
+
+        files = {}
+        pieces = []  # per file: old row range to copy, or chunks to embed
+        counts = {"files": 0, "changed": 0, "removed": 0, "chunks": 0}
+        max_chars = INDEX_CHUNK_TOKENS * CHARS_PER_TOKEN
+        for rel, full in indexable_files(self.root):
+            try:
+                st = os.stat(full)
+                old = old_files.get(rel)
+                if old and (old["mtime"], old["size"]) == (st.st_mtime, st.st_size):
+                    files[rel] = old
+                    pieces.append((old_offsets[rel], len(old["chunks"])))
+                    continue
+                with open(full, "rb") as f:
+                    data = f.read()
+            except OSError:
+                continue
+            if b"\0" in data[:8192]:
+                continue  # binary
+            digest = hashlib.sha256(data).hexdigest()
+            entry = {"mtime": st.st_mtime, "size": st.st_size, "hash": digest}
+            if old and old["hash"] == digest:
+                # Touched but unchanged: keep the vectors
+                files[rel] = {**old, **entry}
+                pieces.append((old_offsets[rel], len(old["chunks"])))
+                continue
+            entry["chunks"] = chunk_lines(data.decode("utf-8", "replace"), max_chars)
+            files[rel] = entry
+            pieces.append(entry["chunks"])
+            counts["changed"] += 1
+        counts["removed"] = len(set(old_files) - set(files))
+        counts["files"] = len(files)
+
+        # Embed the new chunks in batches, several requests at once
+        texts = [
+            f"{rel}\n{chunk[2]}"
+            for rel, piece in zip(files, pieces)
+            if isinstance(piece, list)
+            for chunk in piece
+        ]
+        batches = [
+            texts[i : i + EMBED_BATCH] for i in range(0, len(texts), EMBED_BATCH)
+        ]
+        new_vectors = []
+        if batches:
+            with ThreadPoolExecutor(BATCH_CONCURRENCY) as executor:
+                for done, vectors in enumerate(
+                    executor.map(lambda b: embed(b, self.model), batches), 1
+                ):
+                    new_vectors.append(vectors)
+                    if progress:
+                        progress(done, len(batches))
+
+        parts = []
+        fresh = iter(np.concatenate(new_vectors) if new_vectors else [])
+        for piece in pieces:
+            if isinstance(piece, list):
+                if piece:
+                    parts.append(np.stack([next(fresh) for _ in piece]))
+            elif piece[1]:
+                parts.append(np.asarray(self.vectors[piece[0] : piece[0] + piece[1]]))
+        dim = parts[0].shape[1] if parts else 0
+        vectors = np.concatenate(parts) if parts else np.zeros((0, dim), np.float32)
+        counts["chunks"] = len(vectors)
+
+        self.meta = {"root": self.root, "model": self.model, "files": files}
+        self._save(vectors)
+        self._load()
+        return counts
+
+    def _save(self, vectors) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        tmp = os.path.join(self.path, "vectors.tmp.npy")
+        _numpy().save(tmp, vectors.astype("float32"))
+        os.replace(tmp, os.path.join(self.path, "vectors.npy"))
+        tmp = os.path.join(self.path, "meta.tmp.json")
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.meta, f)
+        os.replace(tmp, os.path.join(self.path, "meta.json"))
+
+    def search(self, query: str, k: int = CONTEXT_TOP_K) -> list:
+        """The `k` chunks closest to `query`: (score, path, first, last, text)."""
+        if self.vectors is None or not len(self.vectors):
+            return []
+        np = _numpy()
+        scores = self.vectors @ embed([query], self.model)[0]
+        k = min(k, len(scores))
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        return [(float(scores[i]), *self.rows[i]) for i in top]
+
+
+def retrieve_context(root: str, query: str, k: int = CONTEXT_TOP_K) -> str | None:
+    """A system message body with the indexed chunks most related to `query`."""
+    index = EmbeddingIndex(root)
+    if index.vectors is None:
+        raise RuntimeError(f"{root} is not indexed yet: run `orun index {root}`")
+    hits = index.search(query, k)
+    if not hits:
+        return None
+    blocks = [
+        f"{path}:{first}-{last}\n```\n{text}\n```"
+        for _, path, first, last, text in hits
+    ]
+    return (
+        f"Excerpts from {index.root} that may be relevant "
+        "(file:lines, most relevant first):\n\n" + "\n\n".join(blocks)
+    )
+
+
+def index_main(argv: list) -> None:
+    """`orun index DIR`: build or refresh the embedding index of DIR."""
+    parser = argparse.ArgumentParser(
+        prog="orun index", description="Index a directory for --context questions"
+    )
+    parser.add_argument("dir", help="Directory to index")
+    parser.add_argument(
+        "--embed-model",
+        help="Ollama embedding model (default: the one the index was built "
+        f"with, or {EMBED_MODEL}); --context uses the same model",
+    )
+    parser.add_argument(
+        "--hosts",
+        type=lambda v: [h.strip() for h in v.split(",") if h.strip()],
+        default=OLLAMA_HOSTS,
+        help="Comma-separated Ollama hosts (default: ORUN_HOSTS)",
+    )
+    args = parser.parse_args(argv)
+    # Progress is a diagnostic: dimmed in a terminal, on stderr when piped
+    set_output_mode("rich" if sys.stdout.isatty() else "text")
+
+    if not os.path.isdir(args.dir):
+        report_error(f"{args.dir} is not a directory")
+        sys.exit(1)
+    configure_pool(args.hosts)
+    start = time.monotonic()
+    try:
+        index = EmbeddingIndex(args.dir, args.embed_model)
+        counts = index.update(
+            progress=lambda done, total: print_dim(f"embedded {done}/{total} batches")
+        )
+    except (RuntimeError, requests.exceptions.RequestException) as e:
+        report_error(str(e))
+        sys.exit(1)
+    print(
+        f"Indexed {counts['files']} files ({counts['changed']} changed, "
+        f"{counts['removed']} removed): {counts['chunks']} chunks "
+        f"in {time.monotonic() - start:.1f}s"
+    )
+
+
+# ============================================
+# Performance Profiles
+# ============================================
+
+
+def load_profiles(path: str | None = None) -> dict:
+    """The profiles file as {model tag: {profile name: settings}}."""
+    path = path or PROFILES_FILE
+    try:
+        with open(path, encoding="utf-8") as f:
+            profiles = json.load(f)
+    except FileNotFoundError:
+        return {}
+    except ValueError as e:
+        raise ValueError(f"{path}: {e}")
+    if not isinstance(profiles, dict):
+        raise ValueError(f"{path}: expected an object of models")
+    return {model_tag(model): named for model, named in profiles.items()}
+
+
+def save_profiles(profiles: dict, path: str | None = None) -> None:
+    path = path or PROFILES_FILE
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp = f"{path}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(profiles, f, indent=2)
+        f.write("\n")
+    os.replace(tmp, path)
+
+
+def model_profile(model: str, name: str | None, profiles: dict | None = None) -> dict:
+    """Settings of profile `name` (or "default", if any) for `model`."""
+    if profiles is None:
+        profiles = load_profiles()
+    named = profiles.get(model_tag(model), {})
+    if name is None:
+        return named.get("default", {})
+    if name not in named:
+        raise ValueError(f"no profile {name!r} for {model} in {PROFILES_FILE}")
+    return named[name]
+
+
+def profile_options(profile: dict) -> dict:
+    """The Ollama options of a profile."""
+    return {k: v for k, v in profile.items() if k not in PROFILE_META_KEYS}
+
+
+def autotune_run(model: str, options: dict, nonce: int) -> dict:
+    """One tool-less request with `options`; returns its done stats."""
+    engine = ChatEngine(model=model, tools=[], options=options)
+    # A new first line each run keeps Ollama's prompt cache from hiding
+    # prompt processing time
+    messages = [{"role": "user", "content": f"Run {nonce}.\n{AUTOTUNE_PROMPT}"}]
+
+    async def drain():
+        async for event in engine.run(messages):
+            if event["type"] == "done":
+                return event["stats"]
+
+    return asyncio.run(drain())
+
+
+def autotune_score(model: str, options: dict, runs: int, nonce) -> float:
+    """Median seconds of `runs` requests, after one request that loads the model."""
+    autotune_run(model, options, next(nonce))
+    times = []
+    for _ in range(runs):
+        stats = autotune_run(model, options, next(nonce))
+        times.append(stats["elapsed"] - (stats["load_duration"] or 0))
+    times.sort()
+    return times[len(times) // 2]
+
+
+def autotune(model: str, base: dict, runs: int = AUTOTUNE_RUNS) -> tuple:
+    """Find fast options for `model` by trying AUTOTUNE_SWEEP one option at a
+    time, keeping each value that beats the best so far by AUTOTUNE_MIN_GAIN.
+
+    Returns (options, seconds). Settings Ollama rejects (e.g. more GPU
+    layers than fit in memory) are skipped.
+    """
+    fixed = {"num_predict": AUTOTUNE_NUM_PREDICT, "temperature": 0, "seed": 0}
+    nonce = itertools.count()
+    best = dict(base)
+    best_time = autotune_score(model, {**best, **fixed}, runs, nonce)
+    print(f"{_describe(best)}: {best_time:.2f}s")
+    for key, values in AUTOTUNE_SWEEP.items():
+        for value in values:
+            if best.get(key) == value:
+                continue
+            trial = {**best, key: value}
+            try:
+                seconds = autotune_score(model, {**trial, **fixed}, runs, nonce)
+            except requests.exceptions.HTTPError as e:
+                print(f"{_describe(trial)}: failed ({e})")
+                continue
+            faster = seconds < best_time * (1 - AUTOTUNE_MIN_GAIN)
+            print(f"{_describe(trial)}: {seconds:.2f}s" + (" *" if faster else ""))
+            if faster:
+                best, best_time = trial, seconds
+    return best, best_time
+
+
+def _describe(options: dict) -> str:
+    return " ".join(f"{k}={v}" for k, v in options.items()) or "Ollama defaults"
+
+
+def autotune_main(argv: list) -> None:
+    """`orun autotune`: time option sweeps and save the fastest as a profile."""
+    parser = argparse.ArgumentParser(
+        prog="orun autotune",
+        description="Find fast Ollama options for a model and save them "
+        f"as a profile in {PROFILES_FILE}",
+    )
+    parser.add_argument("-md", "--model", default=DEFAULT_MODEL, help="Model to tune")
+    parser.add_argument(
+        "--profile",
+        default="default",
+        help="Profile to write (default: default, used when no --profile is given)",
+    )
+    parser.add_argument(
+        "--num-ctx",
+        type=int,
+        help="Context window to tune for (default: the profile's, or Ollama's)",
+    )
+    parser.add_argument(
+        "--runs",
+        type=int,
+        default=AUTOTUNE_RUNS,
+        help=f"Timed runs per setting (default: {AUTOTUNE_RUNS})",
+    )
+    parser.add_argument(
+        "--hosts",
+        type=lambda v: [h.strip() for h in v.split(",") if h.strip()],
+        default=OLLAMA_HOSTS[:1],
+        help="Ollama host to tune on (default: the first of ORUN_HOSTS)",
+    )
+    args = parser.parse_args(argv)
+
+    configure_pool(args.hosts[:1])
+    try:
+        profiles = load_profiles()
+        profile = profiles.get(model_tag(args.model), {}).get(args.profile, {})
+        base = {"num_ctx": profile["num_ctx"]} if "num_ctx" in profile else {}
+        if args.num_ctx:
+            base["num_ctx"] = args.num_ctx
+        print(f"Tuning {args.model} on {args.hosts[0]}")
+        options, seconds = autotune(args.model, base, max(1, args.runs))
+    except KeyboardInterrupt:
+        sys.exit(130)
+    except requests.exceptions.ConnectionError:
+        report_error(f"Cannot connect to Ollama at {args.hosts[0]}")
+        sys.exit(1)
+    except (ValueError, requests.exceptions.RequestException) as e:
+        report_error(str(e))
+        sys.exit(1)
+
+    tuned = {
+        "seconds": round(seconds, 3),
+        "date": datetime.now().isoformat(timespec="seconds"),
+        "host": args.hosts[0],
+    }
+    # Options the sweep does not cover (and keep_alive) are kept
+    profile = {k: v for k, v in profile.items() if k not in AUTOTUNE_SWEEP}
+    profile.update(options, tuned=tuned)
+    profiles.setdefault(model_tag(args.model), {})[args.profile] = profile
+    save_profiles(profiles)
+    print(
+        f"Fastest: {_describe(options)} ({seconds:.2f}s); "
+        f"saved as profile {args.profile!r} of {model_tag(args.model)}"
+    )
+
 
+# ============================================
+# Daemon Server
+# ============================================
 
-def run_command(command: str) -> str:
-    """Run a shell command."""
-    # Determine shell
-    cmd = []
-    if sys.platform == "win32":
-        shell = "pwsh"
-        if shutil.which("pwsh") is None:
-            shell = "powershell"
-        cmd = [shell, "-Command", command]
-    else:
-        cmd = ["bash", "-c", command]
 
-    try:
-        # Run command
-        result = subprocess.run(cmd, capture_output=True, text=True, check=False)
+class _FrameWriter(io.TextIOBase):
+    """Text stream that sends everything written to it as daemon output frames."""
 
-        output_parts = []
-        if result.stdout:
-            output_parts.append(result.stdout.strip())
-        if result.stderr:
-            output_parts.append(f"stderr: {result.stderr.strip()}")
+    def __init__(self, wfile, tty: bool = True):
+        self.wfile = wfile
+        self.tty = tty  # whether the client's stdout is a terminal
 
-        return (
-            "\n".join(output_parts) if output_parts else "Command executed (no output)"
-        )
-    except Exception as e:
-        return f"Error executing command: {str(e)}"
+    def writable(self) -> bool:
+        return True
 
+    def isatty(self) -> bool:
+        return self.tty
 
-TOOL_DEFINITIONS = [
-    {
-        "type": "function",
-        "function": {
-            "name": "get_current_date",
-            "description": "Get the current date and time",
-            "parameters": {"type": "object", "properties": {}, "required": []},
-        },
-    },
-    {
-        "type": "function",
-        "function": {
-            "name": "run_command",
-            "description": "Run a shell command (pwsh on Windows, bash on Linux). Use this for calculations, checking files, or system tasks.",
-            "parameters": {
-                "type": "object",
-                "required": ["command"],
-                "properties": {
-                    "command": {
-                        "type": "string",
-                        "description": "The command line to execute",
-                    }
-                },
-            },
-        },
-    },
-]
+    def write(self, text: str) -> int:
+        if text:
+            data = text.encode("utf-8", errors="replace")
+            self.wfile.write(b"o" + len(data).to_bytes(4, "big") + data)
+        return len(text)
 
-AVAILABLE_FUNCTIONS = {
-    "get_current_date": get_current_date,
-    "run_command": run_command,
-}
+    def flush(self) -> None:
+        self.wfile.flush()
 
 
-def execute_tool_call(tool_name: str, args) -> str:
-    """Execute a single tool call and return result string."""
-    if RICH_AVAILABLE:
-        console.print(f"[yellow]Running tool: {tool_name}[/yellow] args={args}")
-    else:
-        print(f"Running tool: {tool_name} args={args}")
+class _TtyInput(io.StringIO):
+    """Empty stdin stand-in for a client whose stdin is a terminal."""
 
-    func = AVAILABLE_FUNCTIONS.get(tool_name)
-    if not func:
-        return f"Error: Tool {tool_name} not found"
+    def isatty(self) -> bool:
+        return True
 
-    try:
-        # Handle argument variations (some models might send strings)
-        if isinstance(args, str):
-            try:
-                args = json.loads(args)
-            except ValueError:
-                pass  # Try passing as is if not json
 
-        if isinstance(args, dict):
-            return str(func(**args))
-        else:
-            return str(func())  # No args fallback
-    except Exception as e:
-        return f"Error: {str(e)}"
+class _ClientInput(io.RawIOBase):
+    """The client's stdin, requested from it one frame per read."""
 
+    def __init__(self, rfile, wfile):
+        self.rfile = rfile
+        self.wfile = wfile
+        self.eof = False
 
-# ============================================
-# Chat Logic
-# ============================================
+    def readable(self) -> bool:
+        return True
 
+    def readinto(self, buffer) -> int:
+        if self.eof:
+            return 0
+        size = str(len(buffer)).encode("ascii")
+        self.wfile.write(b"i" + len(size).to_bytes(4, "big") + size)
+        self.wfile.flush()
+        header = self.rfile.read(5)
+        data = b""
+        if len(header) == 5 and header[:1] == b"d":
+            data = self.rfile.read(int.from_bytes(header[1:], "big"))
+        if not data:
+            self.eof = True  # end of input, or the client went away
+            return 0
+        buffer[: len(data)] = data
+        return len(data)
 
-def run_chat(prompt: str, model: str) -> None:  # noqa: C901
-    """Run chat loop with tool support and streaming."""
 
-    system_prompt = """
-    **You are a helpful AI assistant.**
-    - **Be concise, accurate, and practical.**
-    - **You have access to tools (run_command, get_current_date).**
-    - **Use 'run_command' to solve math problems (e.g. using echo or python), check files, or get system info.**
-    - **Answer in plain language unless the user explicitly asks for code.**
-    """
+def _use_environment(env: dict) -> None:
+    """Take on a forwarded caller's environment: tool subprocesses inherit
+    it, and the settings read from it at import are read again."""
+    global OLLAMA_HOSTS, PINNED_MODELS, PROFILES_FILE, EMBED_MODEL
 
-    messages = [
-        {"role": "system", "content": system_prompt},
-        {"role": "user", "content": prompt},
-    ]
+    os.environ.clear()
+    os.environ.update(env)
+    OLLAMA_HOSTS = _env_list("ORUN_HOSTS", OLLAMA_HOST)
+    PINNED_MODELS = _env_list("ORUN_PINNED_MODELS")
+    PROFILES_FILE = os.environ.get("ORUN_PROFILES") or DEFAULT_PROFILES_FILE
+    EMBED_MODEL = os.environ.get("ORUN_EMBED_MODEL", "nomic-embed-text")
 
-    # Max turns to prevent infinite loops
-    MAX_TURNS = 10
-    # uncomment this if you want to see the model name
-    # if RICH_AVAILABLE:
-    #     console.print(f"[dim]Using model: {model}[/dim]")
 
-    for _ in range(MAX_TURNS):
-        payload = {
-            "model": model,
-            "messages": messages,
-            "stream": True,  # Process with streaming
-            "tools": TOOL_DEFINITIONS,
-        }
+def _run_forwarded(request: dict, out: _FrameWriter, stdin) -> int:
+    """Run one forwarded orun invocation with stdio redirected to the client.
 
-        try:
-            response = requests.post(OLLAMA_URL, json=payload, stream=True, timeout=120)
-            response.raise_for_status()
+    `stdin` reads the client's stdin; it is only used when that is not a
+    terminal.
+    """
+    global console
 
-            full_content = ""
-            tool_calls = []
+    if request.get("env") is not None:
+        _use_environment(request["env"])
+    saved = (sys.stdin, sys.stdout, sys.stderr, os.getcwd())
+    saved_console = console
+    sys.stdin = _TtyInput() if request.get("stdin_isatty", True) else stdin
+    sys.stdout = sys.stderr = out
+    console = None
+    if RICH_AVAILABLE and out.isatty():
+        from rich.console import Console
 
-            # Streaming loop
-            if RICH_AVAILABLE:
-                with Live(Markdown(""), console=console, refresh_per_second=10) as live:
-                    for line in response.iter_lines():
-                        if not line:
-                            continue
-                        try:
-                            data = json.loads(line.decode("utf-8"))
-                            if data.get("done", False):
-                                break
-
-                            msg = data.get("message", {})
-
-                            # Accumulate content for display
-                            chunk_content = msg.get("content", "")
-                            if chunk_content:
-                                full_content += chunk_content
-                                live.update(Markdown(full_content))
-
-                            # Setup for tool calls
-                            # Note: Ollama might stream tool calls. We collect them.
-                            if "tool_calls" in msg and msg["tool_calls"]:
-                                for tc in msg["tool_calls"]:
-                                    tool_calls.append(tc)
-
-                        except json.JSONDecodeError:
-                            continue
-                console.print()  # Newline after live
-            else:
-                # Plain text fallback
-                for line in response.iter_lines():
-                    if not line:
-                        continue
-                    try:
-                        data = json.loads(line.decode("utf-8"))
-                        if data.get("done", False):
-                            break
+        console = Console(
+            file=out,
+            force_terminal=True,
+            legacy_windows=False,
+            width=request.get("width") or 80,
+        )
+    try:
+        os.chdir(request.get("cwd") or saved[3])
+        main(request.get("argv") or [])
+        return 0
+    except SystemExit as e:
+        return e.code if isinstance(e.code, int) else (0 if e.code is None else 1)
+    except Exception as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 1
+    finally:
+        out.flush()
+        sys.stdin, sys.stdout, sys.stderr = saved[:3]
+        os.chdir(saved[3])
+        console = saved_console
 
-                        msg = data.get("message", {})
 
-                        chunk_content = msg.get("content", "")
-                        if chunk_content:
-                            print(chunk_content, end="", flush=True)
-                            full_content += chunk_content
+def serve_daemon(path: str = DAEMON_SOCKET) -> None:
+    """Serve forwarded orun calls on a Unix socket until interrupted.
 
-                        if "tool_calls" in msg and msg["tool_calls"]:
-                            for tc in msg["tool_calls"]:
-                                tool_calls.append(tc)
+    Each call runs in a process forked from the daemon, so calls run side
+    by side and cannot change each other's cwd, environment or stdio, while
+    the imports and the Console setup are already done.
+    """
+    import socketserver
 
-                    except json.JSONDecodeError:
-                        continue
-                print()
+    if not hasattr(socket, "AF_UNIX") or not hasattr(os, "fork"):
+        report_error("--daemon needs Unix domain sockets and fork")
+        sys.exit(1)
 
-            # Construct the assistant message for history
-            assistant_msg = {"role": "assistant", "content": full_content}
-            if tool_calls:
-                assistant_msg["tool_calls"] = tool_calls
-                messages.append(assistant_msg)
+    class Server(socketserver.ForkingMixIn, socketserver.UnixStreamServer):
+        block_on_close = False
 
-                # Execute tools
-                for tool_call in tool_calls:
-                    fn = tool_call["function"]
-                    result_content = execute_tool_call(fn["name"], fn["arguments"])
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            try:
+                # A client that never finishes its request must not linger
+                self.connection.settimeout(DAEMON_REQUEST_TIMEOUT)
+                line = self.rfile.readline()
+                self.connection.settimeout(None)
+                request = json.loads(line or b"{}")
+                out = _FrameWriter(self.wfile, request.get("isatty", True))
+                stdin = io.TextIOWrapper(
+                    io.BufferedReader(_ClientInput(self.rfile, self.wfile)),
+                    encoding="utf-8",
+                    errors="replace",
+                )
+                code = _run_forwarded(request, out, stdin)
+                data = str(code).encode("ascii")
+                self.wfile.write(b"x" + len(data).to_bytes(4, "big") + data)
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # client went away (e.g. Ctrl+C)
+            except (TimeoutError, ValueError):
+                pass  # incomplete or malformed request
 
-                    messages.append(
-                        {
-                            "role": "tool",
-                            "content": result_content,
-                        }
-                    )
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    if os.path.exists(path):
+        os.unlink(path)
 
-                # Continue loop to process tool results
-                continue
+    def stop(signum, frame):
+        raise KeyboardInterrupt
 
-            else:
-                # No tools used, session done
-                return
+    # `kill` (and a background job's Ctrl+C) should also remove the socket
+    signal.signal(signal.SIGTERM, stop)
 
-        except requests.exceptions.ConnectionError:
-            print(f"Error: Cannot connect to Ollama at {OLLAMA_URL}")
-            print("Make sure Ollama is running: ollama serve")
-            sys.exit(1)
-        except Exception as e:
-            print(f"Error: {e}")
-            sys.exit(1)
+    # Only the owner may connect (a caller can run anything as us): the
+    # socket is created without group/other access rather than chmod-ed
+    # after bind, which would leave a window open
+    umask = os.umask(0o077)
+    try:
+        server = Server(path, Handler)
+    finally:
+        os.umask(umask)
+    print(f"orun daemon listening on {path} (Ctrl+C to stop)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        if os.path.exists(path):
+            os.unlink(path)
 
 
-def parse_args():
-    """Parse command line arguments."""
+def build_parser() -> argparse.ArgumentParser:
+    """The command line parser for chat calls."""
     parser = argparse.ArgumentParser(
         description="Ollama Run - CLI with Markdown Output",
         formatter_class=argparse.RawDescriptionHelpFormatter,
         epilog="""
 Examples:
   orun "how to create new branch"
-  orun "calculate 1245*1457"  # Uses run_command tool
+  orun "calculate 1245*1457"  # Uses calculate tool
   orun "what time is it"      # Uses get_current_date tool
   orun -md="llama3" "hello"
         """,
     )
 
     parser.add_argument(
-        "prompt", nargs="?", help="The prompt/question to send to Ollama"
+        "prompt",
+        nargs="?",
+        help='The prompt/question to send to Ollama ("-": read it from stdin)',
+    )
+
+    parser.add_argument(
+        "--stdin",
+        action="store_true",
+        help="Append piped input to the prompt (stdin is not read otherwise)",
     )
 
     parser.add_argument(
@@ -309,24 +4175,500 @@ Examples:
         help=f"Model to use (default: {DEFAULT_MODEL})",
     )
 
-    return parser.parse_args()
+    parser.add_argument(
+        "--models",
+        type=lambda v: [m.strip() for m in v.split(",") if m.strip()],
+        metavar="A,B,...",
+        help="Ask several models the same prompt at once and compare "
+        "their answers, latency and throughput",
+    )
+
+    parser.add_argument(
+        "-o",
+        "--output",
+        choices=OUTPUT_MODES,
+        help="rich: Markdown in the terminal; text: plain answer; ndjson: one "
+        "JSON event per line (default: rich on a terminal, ndjson when piped)",
+    )
+
+    parser.add_argument(
+        "-s",
+        "--session",
+        metavar="NAME",
+        help="Continue (or start) a named conversation kept on disk",
+    )
+
+    parser.add_argument(
+        "--num-ctx",
+        type=int,
+        help=f"Context window to request and budget for (default: {NUM_CTX})",
+    )
+
+    parser.add_argument(
+        "--profile",
+        metavar="NAME",
+        default=os.environ.get("ORUN_PROFILE"),
+        help="Ollama options profile of the model, from "
+        f'{PROFILES_FILE} (default: the model\'s "default" profile, if any)',
+    )
+
+    parser.add_argument(
+        "--connect-timeout",
+        type=float,
+        default=CONNECT_TIMEOUT,
+        help=f"Seconds to wait for a connection to Ollama (default: {CONNECT_TIMEOUT})",
+    )
+
+    parser.add_argument(
+        "--read-timeout",
+        type=float,
+        default=READ_TIMEOUT,
+        help=f"Seconds to wait for streamed data from Ollama (default: {READ_TIMEOUT})",
+    )
+
+    parser.add_argument(
+        "--pool-size",
+        type=int,
+        default=HTTP_POOL_SIZE,
+        help=f"Max pooled HTTP connections per host (default: {HTTP_POOL_SIZE})",
+    )
+
+    parser.add_argument(
+        "--hosts",
+        type=lambda v: [h.strip() for h in v.split(",") if h.strip()],
+        default=OLLAMA_HOSTS,
+        help="Comma-separated Ollama hosts to balance over "
+        f"(default: ORUN_HOSTS or {OLLAMA_HOST})",
+    )
+
+    parser.add_argument(
+        "--balance",
+        choices=["least-outstanding", "latency"],
+        default=POOL_STRATEGY,
+        help=f"How requests are spread over --hosts (default: {POOL_STRATEGY})",
+    )
+
+    parser.add_argument(
+        "--hedge",
+        action="store_true",
+        help="With several --hosts, also send a request to a second host when "
+        "its first token is late; the first to answer wins",
+    )
+
+    parser.add_argument(
+        "--hedge-percentile",
+        type=float,
+        default=HEDGE_PERCENTILE,
+        metavar="P",
+        help="Hedge when the first token is later than this percentile of "
+        f"recent ones (default: {HEDGE_PERCENTILE})",
+    )
+
+    parser.add_argument(
+        "--no-keep-alive",
+        action="store_true",
+        help="Close the HTTP connection after each request",
+    )
+
+    parser.add_argument(
+        "--warm",
+        nargs="?",
+        const="",
+        metavar="MODEL",
+        help="Preload MODEL (default: --model) into memory and exit",
+    )
+
+    parser.add_argument(
+        "--unload",
+        nargs="?",
+        const="",
+        metavar="MODEL",
+        help="Unload MODEL (default: --model) from memory and exit",
+    )
+
+    parser.add_argument(
+        "--pin",
+        action="store_true",
+        help=(
+            "With --warm/--unload, also act on PINNED_MODELS "
+            "(pinned models are kept loaded indefinitely)"
+        ),
+    )
+
+    parser.add_argument(
+        "--keep-alive",
+        metavar="DURATION",
+        help=(
+            "How long Ollama keeps the model loaded after a request, e.g. 10m, 2h, "
+            f"-1 for forever (--warm default: {WARM_KEEP_ALIVE})"
+        ),
+    )
+
+    parser.add_argument(
+        "--batch",
+        metavar="FILE",
+        help="Answer every prompt in a JSONL file (see --concurrency, --out)",
+    )
+
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=BATCH_CONCURRENCY,
+        help="Prompts answered at once in batch and map-reduce mode "
+        f"(default: {BATCH_CONCURRENCY})",
+    )
+
+    parser.add_argument(
+        "--map-reduce",
+        action="store_true",
+        help="Answer the prompt over input larger than the context: split "
+        "--file/stdin into chunks, answer each, then combine the answers",
+    )
+
+    parser.add_argument(
+        "--file",
+        action="append",
+        default=[],
+        metavar="PATH",
+        help='Input file for --map-reduce (repeatable; default and "-": stdin)',
+    )
+
+    parser.add_argument(
+        "--chunk-tokens",
+        type=int,
+        help="Tokens per --map-reduce chunk "
+        f"(default: {MAP_CHUNK_SHARE:.0%} of the context window)",
+    )
+
+    parser.add_argument(
+        "--context",
+        metavar="DIR",
+        help="Add the excerpts of DIR most related to the prompt "
+        "(index it first: orun index DIR)",
+    )
+
+    parser.add_argument(
+        "--top-k",
+        type=int,
+        default=CONTEXT_TOP_K,
+        help=f"Excerpts added by --context (default: {CONTEXT_TOP_K})",
+    )
+
+    parser.add_argument(
+        "--out",
+        metavar="FILE",
+        help="Batch results file (JSONL); reruns skip prompts already answered",
+    )
+
+    parser.add_argument(
+        "--tool-cache",
+        action="store_true",
+        help=f"Reuse results of repeated read-only tool calls for {TOOL_CACHE_TTL}s",
+    )
+
+    parser.add_argument(
+        "--cache",
+        action=argparse.BooleanOptionalAction,
+        default=RESPONSE_CACHE,
+        help="Replay stored answers for identical requests (--no-cache to disable)",
+    )
+
+    parser.add_argument(
+        "--refresh",
+        action="store_true",
+        help="Regenerate the answer and overwrite the cached one",
+    )
+
+    parser.add_argument(
+        "--cache-stats",
+        action="store_true",
+        help="Show response cache hit/miss statistics and exit",
+    )
+
+    parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="Show TTFT, tokens/s, prompt-eval rate, tool and network time per turn",
+    )
+
+    parser.add_argument(
+        "--stats-json",
+        metavar="FILE",
+        help="Write the --stats numbers (and render counters) to FILE as JSON",
+    )
+
+    parser.add_argument(
+        "-v",
+        "--verbose",
+        action="store_true",
+        help="Print streaming/render diagnostics after the answer",
+    )
+
+    parser.add_argument(
+        "--daemon",
+        action="store_true",
+        help=f"Serve orun calls from a background process with imports done "
+        f"({DAEMON_SOCKET})",
+    )
+
+    parser.add_argument(
+        "--no-daemon",
+        action="store_true",
+        help="Run in this process even if an orun daemon is listening",
+    )
+
+    return parser
+
+
+def parse_args(argv=None):
+    """Parse command line arguments."""
+    return build_parser().parse_args(argv)
+
+
+def split_command(argv: list) -> tuple:
+    """Find an `index`/`autotune` subcommand behind leading options.
+
+    Returns (command, its arguments), or (None, argv) for a chat call.
+    --no-daemon only matters to daemon_client and is dropped; other leading
+    options (--hosts, -md, ...) are passed on for the subcommand to parse.
+    """
+    takes_value = {
+        option
+        for action in build_parser()._actions
+        if action.nargs not in (0, "?")
+        for option in action.option_strings
+    }
+    i = 0
+    while i < len(argv) and argv[i].startswith("-") and argv[i] not in ("-", "--"):
+        i += 2 if argv[i] in takes_value else 1
+    if i >= len(argv) or argv[i] not in ("index", "autotune"):
+        return None, argv
+    leading = [arg for arg in argv[:i] if arg != "--no-daemon"]
+    return argv[i], leading + argv[i + 1 :]
+
+
+def parse_keep_alive(value: str | None, default=WARM_KEEP_ALIVE):
+    """Ollama accepts durations ("10m") or plain seconds (-1 = forever)."""
+    if value is None:
+        return default
+    try:
+        return int(value)
+    except ValueError:
+        return value
+
+
+def request_options(args, model: str) -> tuple:
+    """Ollama options and keep_alive for `model`: its profile, overridden by
+    the command line."""
+    try:
+        profile = model_profile(model, args.profile)
+    except ValueError as e:
+        report_error(
+            str(e),
+            f"Create one with: orun autotune -md {model} --profile {args.profile}",
+        )
+        sys.exit(1)
+    options = profile_options(profile)
+    if args.num_ctx:
+        options["num_ctx"] = args.num_ctx
+    keep_alive = parse_keep_alive(args.keep_alive, default=profile.get("keep_alive"))
+    return options, keep_alive
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    command, argv = split_command(argv)
+    if command == "index":
+        index_main(argv)
+        return
+    if command == "autotune":
+        autotune_main(argv)
+        return
+
+    args = parse_args(argv)
+    set_output_mode(args.output or ("rich" if sys.stdout.isatty() else "ndjson"))
 
+    if args.daemon:
+        # Before any HTTP or pool threads: forked calls set up their own
+        serve_daemon()
+        return
 
-def main():
-    args = parse_args()
+    configure_http(
+        pool_size=max(
+            args.pool_size,
+            args.concurrency if args.batch or args.map_reduce else 0,
+            len(args.models or ()),
+        ),
+        keep_alive=not args.no_keep_alive,
+        connect_timeout=args.connect_timeout,
+        read_timeout=args.read_timeout,
+    )
+    pool = configure_pool(
+        args.hosts, args.balance, args.hedge_percentile if args.hedge else None
+    )
+    if len(pool.endpoints) > 1 and not (
+        args.warm is not None or args.unload is not None
+    ):
+        pool.start_health_checks()
+
+    if args.cache_stats:
+        stats = ResponseCache().stats()
+        print(
+            f"Response cache: {stats['entries']} entries, "
+            f"{stats['bytes'] / 1024 / 1024:.1f} MiB, "
+            f"{stats['hits']} hits / {stats['misses']} misses "
+            f"({stats['hit_rate']:.0%} hit rate)"
+        )
+        return
+
+    if args.warm is not None or args.unload is not None:
+        target = args.warm if args.warm is not None else args.unload
+        models = [target or args.model] if target or not args.pin else []
+        pinned = PINNED_MODELS if args.pin else []
+        if args.warm is not None:
+            warm_models(models, parse_keep_alive(args.keep_alive), pinned)
+        else:
+            unload_models(models + [m for m in pinned if m not in models])
+        return
+
+    if args.tool_cache:
+        enable_tool_cache()
+    if args.cache or args.refresh:
+        enable_response_cache(refresh=args.refresh)
+
+    if args.batch:
+        try:
+            asyncio.run(
+                run_batch(
+                    args.batch,
+                    args.out,
+                    args.model,
+                    max(1, args.concurrency),
+                    request_options(args, args.model)[0],
+                )
+            )
+        except KeyboardInterrupt:
+            cancel_tools()
+            sys.exit(130)
+        except BrokenPipeError:
+            raise
+        except OSError as e:
+            report_error(str(e))
+            sys.exit(1)
+        return
 
     # Get prompt from either positional arg or -m flag
-    prompt = args.prompt or args.message
+    read_stdin = args.stdin or args.prompt == "-"
+    prompt = args.message if args.prompt == "-" else args.prompt or args.message
+
+    if args.file and not args.map_reduce:
+        report_error("--file is only used with --map-reduce")
+        sys.exit(1)
+    if args.map_reduce:
+        if not prompt:
+            report_error("--map-reduce needs a prompt (the task to run on the input)")
+            sys.exit(1)
+        stdin = None
+        files = [path for path in args.file if path != "-"]
+        if not sys.stdin.isatty() and (
+            read_stdin or len(files) < len(args.file) or not files
+        ):
+            stdin = sys.stdin.buffer
+        options, keep_alive = request_options(args, args.model)
+        chunk_tokens = args.chunk_tokens or int(
+            options.get("num_ctx", NUM_CTX) * MAP_CHUNK_SHARE
+        )
+        max_bytes = chunk_tokens * CHARS_PER_TOKEN
+        try:
+            final_prompt = asyncio.run(
+                map_reduce(
+                    prompt,
+                    input_chunks(files, stdin, max_bytes),
+                    args.model,
+                    max(1, args.concurrency),
+                    max_bytes,
+                    options,
+                )
+            )
+        except KeyboardInterrupt:
+            sys.exit(130)
+        except requests.exceptions.ConnectionError:
+            report_error(
+                f"Cannot connect to Ollama at {', '.join(pool.hosts)}",
+                "Make sure Ollama is running: ollama serve",
+            )
+            sys.exit(1)
+        except (OSError, ValueError, requests.exceptions.RequestException) as e:
+            report_error(str(e))
+            sys.exit(1)
+        run_chat(
+            final_prompt,
+            args.model,
+            verbose=args.verbose,
+            options=options,
+            keep_alive=keep_alive,
+            show_stats=args.stats,
+            stats_json=args.stats_json,
+        )
+        return
+
+    # Piped input is appended to the prompt (or is the prompt)
+    if read_stdin and not sys.stdin.isatty():
+        piped = sys.stdin.read().strip()
+        if piped:
+            prompt = f"{prompt}\n\n{piped}" if prompt else piped
 
     if not prompt:
-        print("Error: No prompt provided!")
-        print('Usage: orun "your question here"')
+        report_error("No prompt provided!", 'Usage: orun "your question here"')
         sys.exit(1)
 
+    session = None
+    if args.session:
+        try:
+            session = ChatSession(args.session)
+        except ValueError as e:
+            report_error(str(e))
+            sys.exit(1)
+
+    context = None
+    if args.context:
+        try:
+            context = retrieve_context(args.context, prompt, max(1, args.top_k))
+        except (RuntimeError, requests.exceptions.RequestException) as e:
+            report_error(str(e))
+            sys.exit(1)
+
+    if args.models:
+        if session:
+            report_error("--models cannot be combined with --session")
+            sys.exit(1)
+        run_compare(
+            prompt,
+            {model: request_options(args, model) for model in args.models},
+            verbose=args.verbose,
+            context=context,
+        )
+        return
+
     model = args.model
+    options, keep_alive = request_options(args, model)
     # Switch main logic to chat loop
-    run_chat(prompt, model)
+    run_chat(
+        prompt,
+        model,
+        verbose=args.verbose,
+        options=options,
+        session=session,
+        keep_alive=keep_alive,
+        show_stats=args.stats,
+        stats_json=args.stats_json,
+        context=context,
+    )
 
 
 if __name__ == "__main__":
-    main()
+    try:
+        main()
+    except BrokenPipeError:
+        _discard_stdout()  # e.g. `orun "q" | head -2` stopped reading
+        sys.exit(1)
@@ -0,0 +1,498 @@
+#!/usr/bin/env python3
+"""
+orun Bench - Offline benchmark for orun's streaming and rendering path
+
+Starts a local stand-in for Ollama's /api/chat that replays synthetic (or
+recorded) NDJSON streams, then measures orun's client-side overhead:
+
+    parse     frame decoding throughput (no network)
+    render    CPU time spent drawing streamed Markdown
+    memory    Python allocations of a full run_chat above the memory in use
+              before it: the peak, and what is still held afterwards (growth)
+    e2e       end-to-end latency of run_chat against the fake server, and
+              new connections per call once the pool is warm (should be 0)
+
+Usage:
+    python3 orun_bench.py
+    python3 orun_bench.py --rate 200 --chunk-size 4 --length 20000
+    python3 orun_bench.py --tool-turns 2 --iterations 10
+    python3 orun_bench.py --replay recorded.ndjson
+    python3 orun_bench.py --json results.json
+    python3 orun_bench.py --baseline results.json   # exit 1 on regression
+
+A recorded stream is the raw body of an /api/chat response, e.g.:
+    curl -s localhost:11434/api/chat -d '{"model": "...", "messages": [...]}' \\
+        > recorded.ndjson
+"""
+
+import argparse
+import asyncio
+import gc
+import io
+import json
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import orun
+
+if orun.RICH_AVAILABLE:
+    from rich.console import Console
+
+# ============================================
+# Configuration
+# ============================================
+
+DEFAULT_RATE = 0  # tokens per second, 0 = as fast as possible
+DEFAULT_CHUNK_SIZE = 4  # characters per content frame (about one token)
+DEFAULT_LENGTH = 8000  # characters per synthetic answer
+DEFAULT_ITERATIONS = 5
+MEMORY_RUNS = 3  # run_chat calls measured for memory (median growth)
+DEFAULT_TOLERANCE = 0.25  # allowed slowdown against --baseline
+
+# Metrics where a larger value is a regression
+LOWER_IS_BETTER = {
+    "render_cpu_s",
+    "render_cpu_per_chunk_us",
+    "render_frame_ms",
+    "memory_peak_kib",
+    "memory_growth_kib",
+    "e2e_median_s",
+    "e2e_p95_s",
+    "ttft_median_s",
+    "e2e_connections_per_run",
+}
+
+# ============================================
+# Synthetic Streams
+# ============================================
+
+PARAGRAPH = (
+    "Streaming **Markdown** output exercises the renderer with `inline code`, "
+    "emphasis and links like [docs](https://example.com). "
+)
+CODE_BLOCK = "```python\ndef handler(event):\n    return {'ok': True}\n```\n\n"
+
+
+def synthetic_text(length: int) -> str:
+    """Markdown answer of about `length` characters: headings, lists, code."""
+    parts = []
+    size = 0
+    section = 0
+    while size < length:
+        section += 1
+        block = (
+            f"## Section {section}\n\n{PARAGRAPH * 3}\n\n"
+            f"- item one\n- item two\n\n{CODE_BLOCK}"
+        )
+        parts.append(block)
+        size += len(block)
+    return "".join(parts)[:length]
+
+
+def content_frames(text: str, chunk_size: int, model: str = "bench") -> list:
+    """Split an answer into /api/chat stream frames plus a done frame."""
+    frames = [
+        {
+            "model": model,
+            "message": {"role": "assistant", "content": text[i : i + chunk_size]},
+            "done": False,
+        }
+        for i in range(0, len(text), chunk_size)
+    ]
+    frames.append(done_frame(model, len(frames)))
+    return frames
+
+
+def tool_call_frames(model: str = "bench") -> list:
+    call = {"function": {"name": "get_current_date", "arguments": {}}}
+    return [
+        {
+            "model": model,
+            "message": {"role": "assistant", "content": "", "tool_calls": [call]},
+            "done": False,
+        },
+        done_frame(model, 1),
+    ]
+
+
+def done_frame(model: str, eval_count: int) -> dict:
+    return {
+        "model": model,
+        "message": {"role": "assistant", "content": ""},
+        "done": True,
+        "total_duration": 1_000_000,
+        "load_duration": 0,
+        "prompt_eval_count": 32,
+        "prompt_eval_duration": 100_000,
+        "eval_count": eval_count,
+        "eval_duration": 900_000,
+    }
+
+
+def load_recording(path: str) -> list:
+    with open(path, encoding="utf-8") as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def encode_frames(frames: list) -> bytes:
+    return b"".join(json.dumps(f).encode("utf-8") + b"\n" for f in frames)
+
+
+# ============================================
+# Fake Ollama Server
+# ============================================
+
+
+class _QuietServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        pass  # clients drop streams they stop early
+
+
+class FakeOllama:
+    """Local /api/chat stand-in that replays NDJSON frames at a token rate.
+
+    The first `tool_turns` requests of a conversation (counted by the tool
+    messages it already contains) answer with a tool call, later ones with
+    the content frames.
+    """
+
+    def __init__(self, frames: list, rate: float = 0, tool_turns: int = 0):
+        self.frames = frames
+        self.rate = rate
+        self.tool_turns = tool_turns
+        self.requests = 0
+        self.connections = 0
+        self.server = _QuietServer(("127.0.0.1", 0), self._handler())
+        self.host = f"http://127.0.0.1:{self.server.server_address[1]}"
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def _handler(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, *args):
+                pass
+
+            def setup(self):
+                super().setup()
+                fake.connections += 1
+
+            def do_GET(self):
+                self._send_json(
+                    {"models": [{"name": "bench:latest"}], "version": "bench"}
+                )
+
+            def do_POST(self):
+                length = int(self.headers.get("Content-Length", 0))
+                request = json.loads(self.rfile.read(length) or b"{}")
+                fake.requests += 1
+                if not self.path.endswith("/api/chat"):
+                    self._send_json({"done": True})
+                    return
+
+                messages = request.get("messages", [])
+                tool_messages = sum(1 for m in messages if m.get("role") == "tool")
+                if tool_messages < fake.tool_turns:
+                    frames = tool_call_frames()
+                else:
+                    frames = fake.frames
+                self._stream(frames)
+
+            def _send_json(self, obj):
+                body = json.dumps(obj).encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def _stream(self, frames):
+                self.send_response(200)
+                self.send_header("Content-Type", "application/x-ndjson")
+                self.send_header("Transfer-Encoding", "chunked")
+                self.end_headers()
+                interval = 1.0 / fake.rate if fake.rate else 0
+                next_send = time.monotonic()
+                for frame in frames:
+                    if interval:
+                        delay = next_send - time.monotonic()
+                        if delay > 0:
+                            time.sleep(delay)
+                        next_send += interval
+                    data = json.dumps(frame).encode("utf-8") + b"\n"
+                    self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+                    self.wfile.flush()
+                self.wfile.write(b"0\r\n\r\n")
+
+        return Handler
+
+
+# ============================================
+# Benchmarks
+# ============================================
+
+
+class RecordedResponse:
+    """Minimal stand-in for a streamed requests.Response over fixed bytes."""
+
+    def __init__(self, body: bytes, chunk_size: int = 8192):
+        self.body = body
+        self.chunk_size = chunk_size
+
+    def iter_content(self, chunk_size: int | None = None):
+        chunk_size = chunk_size or self.chunk_size
+        for i in range(0, len(self.body), chunk_size):
+            yield self.body[i : i + chunk_size]
+
+    def close(self):
+        pass
+
+
+def bench_parse(frames: list, repeat: int = 20) -> dict:
+    """Decode throughput of orun's stream decoder, without a network."""
+    body = encode_frames(frames)
+    start = time.perf_counter()
+    decoded = 0
+    for _ in range(repeat):
+        for _ in orun.iter_response_frames(RecordedResponse(body)):
+            decoded += 1
+    elapsed = time.perf_counter() - start
+    return {
+        "parse_frames_per_s": decoded / elapsed,
+        "parse_mib_per_s": len(body) * repeat / elapsed / 1024 / 1024,
+    }
+
+
+def bench_render(frames: list) -> dict:
+    """CPU time to draw a stream through FrameRenderer and RichSink/PlainSink."""
+    chunks = [
+        f["message"]["content"] for f in frames if f.get("message", {}).get("content")
+    ]
+
+    async def run():
+        if orun.RICH_AVAILABLE:
+            out = Console(
+                file=io.StringIO(), force_terminal=True, width=100, legacy_windows=False
+            )
+            sink = orun.RichSink(out)
+        else:
+            sink = orun.PlainSink()
+        stats = orun.FrameStats()
+        with orun.FrameRenderer(sink, stats) as renderer:
+            for chunk in chunks:
+                renderer.feed(chunk)
+                await asyncio.sleep(0)  # let the ticker draw due frames
+        return stats
+
+    stdout = sys.stdout
+    sys.stdout = io.StringIO()  # PlainSink writes to stdout
+    try:
+        start = time.process_time()
+        stats = asyncio.run(run())
+        cpu = time.process_time() - start
+    finally:
+        sys.stdout = stdout
+    return {
+        "render_cpu_s": cpu,
+        "render_cpu_per_chunk_us": cpu / max(1, len(chunks)) * 1e6,
+        "render_frame_ms": stats.render_time / max(1, stats.frames) * 1000,
+        "render_frames": stats.frames,
+    }
+
+
+def run_chat_once(prompt: str, stats_path: str) -> dict:
+    """One orun.run_chat call with output discarded; returns its stats."""
+    stdout = sys.stdout
+    sys.stdout = io.StringIO()
+    if orun.RICH_AVAILABLE:
+        orun.console = Console(
+            file=sys.stdout, force_terminal=True, width=100, legacy_windows=False
+        )
+    try:
+        orun.run_chat(prompt, "bench", stats_json=stats_path)
+    finally:
+        sys.stdout = stdout
+    with open(stats_path, encoding="utf-8") as f:
+        return json.load(f)["total"]
+
+
+def bench_e2e(fake: FakeOllama, iterations: int) -> dict:
+    """Latency, memory use and new connections of full run_chat calls (tools
+    included) against the fake server, once the pool is warm."""
+    with tempfile.TemporaryDirectory() as tmp:
+        stats_path = os.path.join(tmp, "stats.json")
+        tracemalloc.start()
+        run_chat_once("warm up", stats_path)  # connection pool, imports
+        peaks, growth = [], []
+        for i in range(MEMORY_RUNS):
+            gc.collect()
+            baseline, _ = tracemalloc.get_traced_memory()
+            tracemalloc.reset_peak()
+            run_chat_once(f"memory {i}", stats_path)
+            _, peak = tracemalloc.get_traced_memory()
+            gc.collect()
+            current, _ = tracemalloc.get_traced_memory()
+            peaks.append(peak - baseline)
+            growth.append(current - baseline)
+        tracemalloc.stop()
+
+        elapsed, ttft = [], []
+        connections = fake.connections
+        for i in range(iterations):
+            start = time.perf_counter()
+            stats = run_chat_once(f"question {i}", stats_path)
+            elapsed.append(time.perf_counter() - start)
+            ttft.append(stats["ttft"] or 0.0)
+        connections = fake.connections - connections
+
+    return {
+        "memory_peak_kib": max(peaks) / 1024,
+        "memory_growth_kib": statistics.median(growth) / 1024,
+        "e2e_median_s": statistics.median(elapsed),
+        "e2e_p95_s": percentile(elapsed, 0.95),
+        "ttft_median_s": statistics.median(ttft),
+        "e2e_connections_per_run": connections / iterations,
+    }
+
+
+def percentile(values: list, q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# ============================================
+# Reporting
+# ============================================
+
+
+def print_results(results: dict, baseline: dict | None, tolerance: float) -> list:
+    """Print the metrics (against a baseline if given); return regressions."""
+    regressions = []
+    print(f"{'metric':<28}{'value':>14}{'baseline':>14}{'change':>10}")
+    for name, value in results.items():
+        line = f"{name:<28}{value:>14.3f}"
+        if baseline and name in baseline and baseline[name]:
+            change = (value - baseline[name]) / baseline[name]
+            worse = change if name in LOWER_IS_BETTER else -change
+            flag = ""
+            if name in LOWER_IS_BETTER or name.endswith("_per_s"):
+                if worse > tolerance:
+                    regressions.append(name)
+                    flag = " !"
+            line += f"{baseline[name]:>14.3f}{change:>+9.0%}{flag}"
+        print(line)
+    return regressions
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(
+        description="Offline benchmark for orun's streaming and rendering path",
+        formatter_class=argparse.RawDescriptionHelpFormatter,
+        epilog=__doc__.split("Usage:")[1],
+    )
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=DEFAULT_RATE,
+        help="Frames (tokens) per second sent by the fake server (0 = unlimited)",
+    )
+    parser.add_argument(
+        "--chunk-size",
+        type=int,
+        default=DEFAULT_CHUNK_SIZE,
+        help=f"Characters per content frame (default: {DEFAULT_CHUNK_SIZE})",
+    )
+    parser.add_argument(
+        "--length",
+        type=int,
+        default=DEFAULT_LENGTH,
+        help=f"Characters per synthetic answer (default: {DEFAULT_LENGTH})",
+    )
+    parser.add_argument(
+        "--tool-turns",
+        type=int,
+        default=0,
+        help="Tool-call turns before each answer (default: 0)",
+    )
+    parser.add_argument(
+        "--replay",
+        metavar="FILE",
+        help="Replay a recorded /api/chat NDJSON stream instead of synthetic text",
+    )
+    parser.add_argument(
+        "--iterations",
+        type=int,
+        default=DEFAULT_ITERATIONS,
+        help=f"End-to-end runs (default: {DEFAULT_ITERATIONS})",
+    )
+    parser.add_argument("--json", metavar="FILE", help="Write the results as JSON")
+    parser.add_argument(
+        "--baseline",
+        metavar="FILE",
+        help="Compare with a previous --json file; exit 1 on regressions",
+    )
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=DEFAULT_TOLERANCE,
+        help=f"Allowed relative slowdown against --baseline (default: {DEFAULT_TOLERANCE})",
+    )
+    return parser.parse_args()
+
+
+def main():
+    args = parse_args()
+
+    if args.replay:
+        frames = load_recording(args.replay)
+    else:
+        frames = content_frames(synthetic_text(args.length), args.chunk_size)
+
+    results = {}
+    results.update(bench_parse(frames))
+    results.update(bench_render(frames))
+
+    with FakeOllama(frames, rate=args.rate, tool_turns=args.tool_turns) as fake:
+        orun.configure_pool([fake.host])
+        results.update(bench_e2e(fake, max(1, args.iterations)))
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+    regressions = print_results(results, baseline, args.tolerance)
+    if results["e2e_connections_per_run"] > 0:
+        # A regression even without a baseline: the pool should be reused
+        print("\nNew connections were opened after warm-up")
+        regressions.append("e2e_connections_per_run")
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+
+    if regressions:
+        print(f"\nRegressions beyond {args.tolerance:.0%}: {', '.join(regressions)}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()